@@ -0,0 +1,236 @@
+"""Offline benchmarks for YACRB.
+
+Runs the diff, chunking and tokenizer code paths on synthetic diffs, and a full review
+against local stand-ins for GitHub and OpenAI (see mock_servers.py), so no network access,
+API keys or credits are needed.
+
+    python benchmark.py -files 200 -latency 0.2 -throttle-rate 0.05 -concurrency 8 -json bench.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import statistics
+import importlib.util
+from types import SimpleNamespace
+from mock_servers import MockGitHub, MockOpenAI
+from review_journal import ReviewJournal
+
+def load_code_review():
+    """Import code-review.py, which can't be imported by name because of the dash."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "code-review.py")
+    spec = importlib.util.spec_from_file_location("code_review", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def random_line(rng, width):
+    words = ["value", "result", "config", "items", "index", "user", "request", "response", "data", "cache"]
+    return " " * rng.choice((0, 4, 8)) + " ".join(rng.choice(words) for _ in range(max(1, width // 8)))
+
+def generate_file_diff(rng, path, lines, status="modified", line_width=60):
+    """Build the diff of one file: a few hunks of context, added and deleted lines."""
+    header = [f"diff --git a/{path} b/{path}"]
+    if status == "added":
+        header += ["new file mode 100644", "index 0000000..1111111", "--- /dev/null", f"+++ b/{path}",
+                   f"@@ -0,0 +1,{lines} @@"]
+        return "\n".join(header + ["+" + random_line(rng, line_width) for _ in range(lines)])
+    if status == "deleted":
+        header += ["deleted file mode 100644", "index 1111111..0000000", f"--- a/{path}", "+++ /dev/null",
+                   f"@@ -1,{lines} +0,0 @@"]
+        return "\n".join(header + ["-" + random_line(rng, line_width) for _ in range(lines)])
+    header += ["index 1111111..2222222 100644", f"--- a/{path}", f"+++ b/{path}"]
+    body = []
+    start = 1
+    remaining = lines
+    while remaining > 0:
+        hunk_lines = min(remaining, rng.randint(8, 40))
+        remaining -= hunk_lines
+        body.append(f"@@ -{start},{hunk_lines} +{start},{hunk_lines} @@ def function_{start}():")
+        for _ in range(hunk_lines):
+            body.append(rng.choice(" +-+ ") + random_line(rng, line_width))
+        start += hunk_lines + rng.randint(10, 100)
+    return "\n".join(header + body)
+
+def generate_diff(files=50, lines_per_file=60, minified=2, renames=2, deletions=2, lockfiles=1, added=5, seed=0):
+    """Generate a synthetic PR diff.
+
+    Parameters:
+    - files: Number of modified source files. Their sizes vary around lines_per_file.
+    - minified: Number of minified/bundle files, each a few very long lines.
+    - renames / deletions / added: Number of renamed, deleted and new files.
+    - lockfiles: Number of large lockfiles.
+    """
+    rng = random.Random(seed)
+    sections = []
+    for idx in range(files):
+        ext = rng.choice(["py", "js", "ts", "go", "java"])
+        sections.append(generate_file_diff(rng, f"src/module_{idx}/file_{idx}.{ext}",
+                                           max(1, int(rng.expovariate(1 / lines_per_file)))))
+    for idx in range(added):
+        sections.append(generate_file_diff(rng, f"src/new/file_{idx}.py", lines_per_file, "added"))
+    for idx in range(deletions):
+        sections.append(generate_file_diff(rng, f"src/old/file_{idx}.py", lines_per_file, "deleted"))
+    for idx in range(renames):
+        sections.append(f"diff --git a/src/a_{idx}.py b/src/b_{idx}.py\nsimilarity index 100%\n"
+                        f"rename from src/a_{idx}.py\nrename to src/b_{idx}.py")
+    for idx in range(minified):
+        name = f"static/app_{idx}.min.js" if idx % 2 == 0 else f"static/bundle_{idx}.js"
+        sections.append(generate_file_diff(rng, name, 5, line_width=5000))
+    for idx in range(lockfiles):
+        sections.append(generate_file_diff(rng, f"package-lock.json" if idx == 0 else f"pkg_{idx}/yarn.lock",
+                                           lines_per_file * 20))
+    return "\n".join(sections) + "\n"
+
+class ByteTokenizer:
+    """Stand-in tokenizer (one token per byte) used when the tiktoken files aren't cached locally."""
+    name = "bytes"
+
+    def encode(self, text):
+        return list(text.encode("utf-8"))
+
+    def decode(self, tokens):
+        return bytes(tokens).decode("utf-8", errors="replace")
+
+    def decode_tokens_bytes(self, tokens):
+        return [bytes((token,)) for token in tokens]
+
+def get_benchmark_tokenizer(code_review, model):
+    """Use the real tokenizer if it can be loaded offline, otherwise fall back to ByteTokenizer."""
+    try:
+        return code_review.get_tokenizer(model), True
+    except Exception:
+        encoding_name = code_review.MODEL_ENCODINGS.get(model, code_review.DEFAULT_ENCODING)
+        code_review.tokenizers[encoding_name] = ByteTokenizer()
+        return code_review.tokenizers[encoding_name], False
+
+def time_it(function, repeat):
+    """Run function repeat times and return (median seconds, last result)."""
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), result
+
+def run_micro_benchmarks(code_review, tokenizer, diff_text, repeat):
+    """Benchmark the diff filtering, segmenting, tokenizing and chunking code paths."""
+    results = {}
+    size_mb = len(diff_text.encode("utf-8")) / (1024 * 1024)
+
+    seconds, filtered = time_it(lambda: code_review.filter_diff(diff_text), repeat)
+    results["filter_diff"] = {"seconds": seconds, "mb_per_second": size_mb / seconds}
+
+    seconds, segments = time_it(lambda: code_review.segment_diff_by_files(filtered), repeat)
+    results["segment_diff_by_files"] = {"seconds": seconds, "files": len(segments),
+                                        "files_per_second": len(segments) / seconds}
+
+    seconds, encoded = time_it(lambda: [tokenizer.encode(segment) for segment in segments], repeat)
+    token_count = sum(len(tokens) for tokens in encoded)
+    results["tokenize"] = {"seconds": seconds, "tokens": token_count, "tokens_per_second": token_count / seconds}
+
+    chunk_size = code_review.TOKEN_SIZE
+    seconds, chunks = time_it(
+        lambda: [chunk for tokens in encoded for chunk in code_review.encode_segments(tokens, tokenizer, chunk_size)], repeat)
+    results["encode_segments"] = {"seconds": seconds, "chunks": len(chunks), "tokens_per_second": token_count / seconds}
+    return results
+
+def run_end_to_end(code_review, diff_text, args):
+    """Fetch a synthetic PR from the mock GitHub and review it against the mock OpenAI."""
+    github = MockGitHub({1: diff_text}, latency=args.github_latency).start()
+    openai = MockOpenAI(latency=args.latency, throttle_rate=args.throttle_rate, stream_delay=args.stream_delay,
+                        seed=args.seed).start()
+    try:
+        code_review.GITHUB_API_URL = github.url
+        code_review.OPEN_AI_URL = f"{openai.url}/v1/chat/completions"
+        # No GitHub cache, so every run fetches the diff the same way
+        code_review.configure_github_client("benchmark", cache_file=None)
+        # Retry throttled requests quickly, the mock asks for short waits anyway
+        code_review.get_rate_limiter().base_backoff = 0.05
+        review_args = SimpleNamespace(model=args.model, concurrency=args.concurrency, no_cache=True,
+                                      budget=args.budget, stream=False)
+
+        start = time.perf_counter()
+        diff = code_review.get_pull_request_diff("benchmark", "synthetic", 1, args.budget)
+        fetch_seconds = time.perf_counter() - start
+        with tempfile.TemporaryDirectory() as journal_dir:
+            # The reviews are only kept in the journal, which is thrown away with the directory
+            journal = ReviewJournal(os.path.join(journal_dir, "benchmark.jsonl"))
+            try:
+                failed = code_review.review_code_with_chatgpt(diff, "benchmark", "You are a code reviewer.", review_args,
+                                                              journal)
+            finally:
+                journal.close()
+        total_seconds = time.perf_counter() - start
+
+        metrics = code_review.metrics.to_dict()
+        latency = metrics["histograms"].get("request_seconds", {})
+        return {
+            "seconds": total_seconds,
+            "fetch_seconds": fetch_seconds,
+            "files": len(diff),
+            "files_per_second": len(diff) / total_seconds,
+            "requests": openai.request_count,
+            "requests_per_second": openai.request_count / total_seconds,
+            "throttled": openai.throttled,
+            "mean_request_seconds": latency.get("mean", 0),
+            "max_request_seconds": latency.get("max", 0),
+            "rate_limit_sleep_seconds": metrics["counters"].get("rate_limit_sleep_seconds", 0),
+            "review_failed": failed > 0
+        }
+    finally:
+        github.stop()
+        openai.stop()
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark YACRB offline against synthetic diffs and mock servers.')
+    parser.add_argument('-files', dest='files', type=int, default=100, help='Number of modified files in the synthetic diff.')
+    parser.add_argument('-lines', dest='lines', type=int, default=60, help='Average changed lines per file.')
+    parser.add_argument('-seed', dest='seed', type=int, default=0, help='Seed for the synthetic diff and injected 429s.')
+    parser.add_argument('-repeat', dest='repeat', type=int, default=5, help='Runs of each micro benchmark (the median is reported).')
+    parser.add_argument('-model', dest='model', default='gpt-3.5-turbo-16k', help='Model used for tokenizing and chunking.')
+    parser.add_argument('-concurrency', dest='concurrency', type=int, default=8, help='Files reviewed in parallel end to end.')
+    parser.add_argument('-latency', dest='latency', type=float, default=0.1, help='Seconds of latency of the mock OpenAI.')
+    parser.add_argument('-github-latency', dest='github_latency', type=float, default=0.05, help='Seconds of latency of the mock GitHub.')
+    parser.add_argument('-stream-delay', dest='stream_delay', type=float, default=0.0, help='Seconds between streamed chunks.')
+    parser.add_argument('-throttle-rate', dest='throttle_rate', type=float, default=0.0, help='Fraction of OpenAI requests answered with a 429.')
+    parser.add_argument('-budget', dest='budget', type=int, default=10 ** 9, help='Token budget for the end to end review.')
+    parser.add_argument('-skip-e2e', dest='skip_e2e', action='store_true', help='Only run the micro benchmarks.')
+    parser.add_argument('-json', dest='json_file', default=None, help='Save the results to this JSON file to compare across versions.')
+    return parser.parse_args()
+
+def print_results(results):
+    for name, values in results.items():
+        if not isinstance(values, dict):
+            print(f"{name}: {values}")
+            continue
+        print(f"\n{name}")
+        for key, value in values.items():
+            print(f"  {key:<26} {value:.4f}" if isinstance(value, float) else f"  {key:<26} {value}")
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    code_review = load_code_review()
+    code_review.model = args.model
+    tokenizer, real_tokenizer = get_benchmark_tokenizer(code_review, args.model)
+    if not real_tokenizer:
+        print("tiktoken files aren't cached, using a byte tokenizer. Run code-review.py -warm-cache DIR "
+              "and set TOKENIZER_CACHE_DIR=DIR to benchmark the real tokenizer.", file=sys.stderr)
+
+    diff_text = generate_diff(files=args.files, lines_per_file=args.lines, seed=args.seed)
+    results = {
+        "tokenizer": getattr(tokenizer, "name", "unknown"),
+        "diff": {"bytes": len(diff_text.encode("utf-8")), "files": diff_text.count("diff --git")}
+    }
+    results.update(run_micro_benchmarks(code_review, tokenizer, diff_text, args.repeat))
+    if not args.skip_e2e:
+        results["end_to_end"] = run_end_to_end(code_review, diff_text, args)
+
+    print_results(results)
+    if args.json_file:
+        with open(args.json_file, "w") as file:
+            json.dump(results, file, indent=2)
@@ -1,13 +1,30 @@
 import sys
-import requests
 import json
-import tiktoken
 import os
 import re
 import argparse
+import bisect
+import functools
+import atexit
+import math
+import time
+import threading
+import requests
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor, Future, InvalidStateError, as_completed
 from termcolor import colored
 from rate_limiter import RateLimiter
+from http_client import HttpClient
+from review_cache import ReviewCache
+from review_journal import ReviewJournal
+from github_cache import GitHubCache, GitHubClient
+from stream_writer import OrderedStreamWriter
+from review_server import ReviewServer, ReviewJobQueue
+from metrics import Metrics
+from diff_compactor import DiffCompactor
+from diff_dedup import HunkDeduplicator
+from llm_backends import Backend, ModelRouter, DEFAULT_BACKEND, get_completions_url
+from diff_parser import parse_diff, filter_file_diffs, split_lines, is_low_priority, added_line_density
 
 def print_asc_logo(): 
     logo = """
@@ -33,43 +50,91 @@ OPEN_AI_URL = "https://api.openai.com/v1/chat/completions"
 HEADERS = {}
 TOKEN_SIZE = 5120                   # Max tokens to send at once when splitting diffs
 MAX_TOKENS = 2048                   # response size
-MAX_DIFF_TOKEN_SIZE = 30000         # Max token size of a diff past which the code review is skipped
+MAX_DIFF_TOKEN_SIZE = 30000         # Token budget for a review, files past it are truncated or skipped (see -budget)
+DIFF_CHARS_PER_TOKEN = 8            # Characters of diff kept per token of budget while downloading, more than a token ever takes
+MIN_TRUNCATED_TOKENS = 500          # Smallest part of a file worth reviewing when it has to be truncated
+MESSAGE_TOKEN_OVERHEAD = 16        # Tokens the chat format adds around the system and user messages
+MODEL_CONTEXT_SIZES = {             # Context window of each model, shared by the prompt, the diff and the response
+    'gpt-4': 8192,
+    'gpt-3.5-turbo': 4096,
+    'gpt-3.5-turbo-16k': 16384
+}
+MODEL_ENCODINGS = {                 # tiktoken encoding used by each model
+    'gpt-4': 'cl100k_base',
+    'gpt-3.5-turbo': 'cl100k_base',
+    'gpt-3.5-turbo-16k': 'cl100k_base'
+}
+DEFAULT_ENCODING = 'cl100k_base'    # Encoding used for models that aren't listed above
+REVIEW_CACHE_FILE = "review_cache.db"          # SQLite file used to cache reviews between runs
+REVIEW_CACHE_MAX_BYTES = 50 * 1024 * 1024       # Size of cached reviews past which the least recently used are evicted
+REVIEW_STATE_FILE = "review_state.json"        # Head SHA last reviewed for each PR, used by -incremental
+JOURNAL_DIR = "journal"                        # Directory of the per-PR journals of finished file reviews, see -resume
+FILE_REVIEW_ATTEMPTS = 2                       # Times a file is reviewed before it is left out as failed
+FAILED_REVIEW_MESSAGE = "Review failed due to an error"
+# Written after the part of a streamed chunk that was sent before the request failed
+STREAM_RETRY_NOTE = "\n[The response was cut off and is retried below]\n"
+GITHUB_CACHE_FILE = "github_cache.db"          # SQLite file of GitHub responses, revalidated with conditional requests
+GITHUB_CACHE_MAX_BYTES = 100 * 1024 * 1024      # Size of cached GitHub responses past which the least recently used are evicted
+GITHUB_CACHE_MAX_RESPONSE_BYTES = 10 * 1024 * 1024  # Largest GitHub response (e.g. a diff) that is cached
+GITHUB_RATE_LIMIT_RESERVE = 20                 # GitHub requests left at which requests wait for the rate limit to reset
+RATE_LIMIT_REQUESTS = 3             # OpenAI requests per minute until the x-ratelimit headers report the real limit
+RATE_LIMIT_TOKENS = 10000           # OpenAI tokens per minute until the x-ratelimit headers report the real limit
+MAX_RETRIES = 5                     # How many times a throttled or failed OpenAI request is retried
+MODEL_PRICES = {                    # USD per 1K prompt and completion tokens, used to estimate the cost of a review
+    'gpt-4': (0.03, 0.06),
+    'gpt-3.5-turbo': (0.0015, 0.002),
+    'gpt-3.5-turbo-16k': (0.003, 0.004)
+}
+HTTP_POOL_SIZE = 10                 # Keep-alive connections per host, raised to match -concurrency
+HTTP_TIMEOUT = (10, 120)            # Connect and read timeouts in seconds for GitHub requests
+COMPLETION_TIMEOUT = (10, 600)      # Connect and read timeouts for chat completions, long enough for a full MAX_TOKENS response
+DIFF_CHUNK_SIZE = 64 * 1024         # Bytes read at a time when streaming a diff from GitHub
+BATCH_PER_PAGE = 100                # Pull requests fetched per page when listing every open PR
+OUTPUT_DIR = "out"                  # Directory that -output and batch reviews are written to
+SERVE_PORT = 8080                   # Port the -serve webhook server listens on
+SERVE_LOCAL_HOST = "127.0.0.1"      # Address -serve listens on when there is no WEBHOOK_SECRET to check deliveries with
+SERVE_WORKERS = 2                   # Pull requests reviewed at the same time in -serve mode
+PACK_REVIEW_TOKENS = 200            # Response tokens to allow for each file when small files share a request
+PACK_SEPARATOR_TOKENS = 2           # Tokens between the diffs of files that share a request
 PER_PAGE = 10                       # How many pull requests to display per page in the menu
 current_menu_page = 1               # When displaying the menu, the current page
 next_url = None                     # The url for the next set of PR records
+tokenizers = {}                     # Encodings loaded so far, keyed by encoding name
+tokenizer_lock = threading.Lock()
+http_client = HttpClient(HTTP_POOL_SIZE, HTTP_TIMEOUT)   # Pooled sessions shared by every GitHub and OpenAI request
+metrics = Metrics()                 # Timings and counters for the run, see -metrics
+# GitHub requests, with the conditional-request cache set up by configure_github_client()
+github_client = GitHubClient(http_client, reserve=GITHUB_RATE_LIMIT_RESERVE, metrics=metrics)
+diff_compactor = DiffCompactor()    # Shrinks file diffs before review, see configure_compaction()
+diff_deduplicator = HunkDeduplicator()  # Reviews changes repeated across files once, see configure_dedup()
+rate_limiter = None                 # OpenAI rate limiter shared by every review, see get_rate_limiter()
+rate_limiter_lock = threading.Lock()
+backends = {}                       # LLM backends by name, see configure_backends() and get_backend()
+routing_rules = []                  # Rules that pick the model of each file, see ModelRouter
+backends_lock = threading.Lock()
+review_state_lock = threading.Lock()
 
 def filter_diff(diff_text):
     """Filters the diff to remove minified css and js files, and ignore deletions."""
-    # Split the diff text by sections
-    sections = re.split(r'\ndiff --git', diff_text)
-
-    # Add back the "diff --git" prefix removed during splitting (except for the first section)
-    sections = [sections[0]] + ['diff --git' + section for section in sections[1:]]
-
-    filtered_sections = []
-
-    for section in sections:
-        # Check if the section is for a minified or bundle file
-        if re.search(r'\.(min\.js|min\.css)|bundle', section):
-            continue
-
-        # Check if the section is only for deleting/moving a file
-        deletions = re.findall(r'^-', section, re.MULTILINE)
-        additions = re.findall(r'^\+', section, re.MULTILINE)
-
-        # If a file has been deleted (only deletions and the destination is /dev/null), skip it.
-        if deletions and not additions and re.search(r'\+\+\+ /dev/null', section):
-            continue
-
-        # If a file has been renamed, skip it.
-        if re.search(r'rename from', section) and re.search(r'rename to', section):
-            continue
-
-        filtered_sections.append(section)
+    file_diffs = filter_file_diffs(parse_diff(split_lines([diff_text])))
+    return '\n'.join(file_diff.text for file_diff in file_diffs)
 
-    # Combine the filtered sections
-    filtered_diff = '\n'.join(filtered_sections)
-    return filtered_diff
+def stream_diff(url, headers, budget=MAX_DIFF_TOKEN_SIZE):
+    """Download a diff and parse it line by line as it arrives.
+    The parsed files are kept, since a review plans and sends them several times, but only up to
+    budget * DIFF_CHARS_PER_TOKEN characters of hunk lines (twice that with lockfiles and generated
+    files, see parse_diff): the lines past it could never fit in the token budget. So memory is
+    bounded by the budget plus a small record (name and status) per file, not by the size of the diff.
+    
+    Returns:
+    - A list of FileDiff records for the files that pass the filter rules, or None if the download failed.
+    """
+    with metrics.phase("github_diff"), github_client.get(url, headers=headers, stream=True) as response:
+        if response.status_code != 200:
+            return None
+        response.encoding = response.encoding or 'utf-8'
+        chunks = response.iter_content(chunk_size=DIFF_CHUNK_SIZE, decode_unicode=True)
+        return list(filter_file_diffs(parse_diff(split_lines(chunks), budget * DIFF_CHARS_PER_TOKEN)))
 
 # Load config from a JSON file or environment variables
 def load_config():
@@ -118,23 +183,50 @@ def load_prompts():
         sys.exit()
     return prompts
 
+def configure_compaction(config, enabled=True):
+    """Set up diff compaction from config.json or environment variables, or turn it off."""
+    global diff_compactor
+    if not enabled:
+        diff_compactor = None
+        return
+    keys = ('COMPACT_CONTEXT_LINES', 'COMPACT_WHITESPACE_HUNKS', 'COMPACT_DELETION_HUNKS', 'COMPACT_STRIP_HEADERS', 'SKIP_PATHS')
+    settings = {key: config[key] if key in config else os.environ.get(key) for key in keys}
+    diff_compactor = DiffCompactor.from_settings({key: value for key, value in settings.items() if value is not None})
+
+def configure_dedup(config, enabled=True):
+    """Set up the deduplication of repeated changes from config.json or environment variables, or turn it off."""
+    global diff_deduplicator
+    if not enabled:
+        diff_deduplicator = None
+        return
+    keys = ('DEDUP_SIMILARITY', 'DEDUP_MIN_HUNK_LINES')
+    settings = {key: config[key] if key in config else os.environ.get(key) for key in keys}
+    diff_deduplicator = HunkDeduplicator.from_settings(settings)
+
+def configure_github_client(github_key, cache_file=GITHUB_CACHE_FILE):
+    """Send the GitHub token and default Accept header with every GitHub request.
+    If cache_file is set, GitHub responses are cached there and revalidated with conditional requests.
+    """
+    http_client.set_default_headers(GITHUB_API_URL, {
+        "Authorization": f"token {github_key}",
+        "Accept": "application/vnd.github.v3+json"
+    })
+    if cache_file and github_client.cache is None:
+        github_client.cache = GitHubCache(cache_file, GITHUB_CACHE_MAX_BYTES, GITHUB_CACHE_MAX_RESPONSE_BYTES)
+
 def get_pull_requests(user, repo, next=""):
     params = {
         "per_page": PER_PAGE,
         "page": 1
     }
-    HEADERS = {
-        "Authorization": f"token {github_api_key}",
-        "Accept": "application/vnd.github.v3+json"
-    }
-
     if len(next):
         url = next
         params={}
     else: 
-        url = f"https://api.github.com/repos/{user}/{repo}/pulls"
+        url = f"{GITHUB_API_URL}/repos/{user}/{repo}/pulls"
 
-    response = requests.get(url, headers=HEADERS, params=params)
+    with metrics.phase("github_fetch"):
+        response = github_client.get(url, params=params)
     global next_url
     next_url = get_next_link(response.headers.get("Link", ""))
     
@@ -144,6 +236,23 @@ def get_pull_requests(user, repo, next=""):
         print("Error:", response.status_code)
         return []
 
+def get_all_open_pull_requests(owner, repo):
+    """Fetch every open pull request of a repository, following the pagination links."""
+    url = f"{GITHUB_API_URL}/repos/{owner}/{repo}/pulls"
+    params = {"state": "open", "per_page": BATCH_PER_PAGE}
+    prs = []
+    while url:
+        with metrics.phase("github_fetch"):
+            response = github_client.get(url, params=params)
+        if response.status_code != 200:
+            print(colored(f"Error listing pull requests for {owner}/{repo}: {response.status_code}", "red"))
+            break
+        prs.extend(response.json())
+        # The next link already carries the query parameters
+        url = get_next_link(response.headers.get("Link", ""))
+        params = {}
+    return prs
+
 def get_pull_request(owner, repo, pr_number):
     """Fetch a single pull request from a given GitHub repository.
     
@@ -155,151 +264,1034 @@ def get_pull_request(owner, repo, pr_number):
     Returns:
     - A JSON response containing pull request details.
     """
-    HEADERS = {
-        "Authorization": f"token {github_api_key}",
-        "Accept": "application/vnd.github.v3+json"
-    }
     url = f"{GITHUB_API_URL}/repos/{owner}/{repo}/pulls/{pr_number}"
-    response = requests.get(url, headers=HEADERS)
+    with metrics.phase("github_fetch"):
+        response = github_client.get(url)
     return response.json()
 
 
-def get_pull_request_diff(owner, repo, pr_number):
+def get_pull_request_diff(owner, repo, pr_number, budget=MAX_DIFF_TOKEN_SIZE):
     """Fetch a single pull request from a given GitHub repository.
     
     Parameters:
     - owner: The owner of the GitHub repository.
     - repo: The name of the GitHub repository.
     - pr_number: The pull request number.
+    - budget: The token budget of the review, which bounds how much of the diff is kept (see stream_diff).
     
     Returns:
-    - A text based DIFF response containing pull request changes.
+    - A list of FileDiff records for the files changed by the pull request.
+    
+    Raises:
+    - ReviewError if the diff can't be downloaded, so a failed download is never mistaken for an empty PR.
     """
     HEADERS = {
-        "Authorization": f"token {github_api_key}",
-        "Accept": "application/vnd.github.v3.diff"
+        "Accept": "application/vnd.github.v3.diff",
+        "Accept-Encoding": "gzip"
     }
     url = f"{GITHUB_API_URL}/repos/{owner}/{repo}/pulls/{pr_number}.diff"
-    print(url)
-    response = requests.get(url, headers=HEADERS)
-    return filter_diff(response.text)
+    diff = stream_diff(url, HEADERS, budget)
+    if diff is None:
+        raise ReviewError(f"Could not download the diff of {owner}/{repo}#{pr_number}")
+    return diff
+
+def get_compare_diff(owner, repo, base_sha, head_sha, budget=MAX_DIFF_TOKEN_SIZE):
+    """Fetch the diff between two commits of a GitHub repository.
+    
+    Parameters:
+    - owner: The owner of the GitHub repository.
+    - repo: The name of the GitHub repository.
+    - base_sha: The commit to compare from.
+    - head_sha: The commit to compare to.
+    - budget: The token budget of the review, see stream_diff.
+    
+    Returns:
+    - A list of FileDiff records for the changes since base_sha, or None if GitHub can't compare the commits
+      (for example, when base_sha was removed by a force push).
+    """
+    HEADERS = {
+        "Accept": "application/vnd.github.v3.diff",
+        "Accept-Encoding": "gzip"
+    }
+    url = f"{GITHUB_API_URL}/repos/{owner}/{repo}/compare/{base_sha}...{head_sha}"
+    return stream_diff(url, HEADERS, budget)
+
+def get_review_state_key(owner, repo, pr_number, review_type):
+    return f"{owner}/{repo}#{pr_number}:{review_type}"
+
+def load_review_state():
+    """Load the head SHA last reviewed for each PR from REVIEW_STATE_FILE."""
+    if os.path.exists(REVIEW_STATE_FILE):
+        with open(REVIEW_STATE_FILE, "r") as file:
+            return json.load(file)
+    return {}
+
+def save_reviewed_sha(owner, repo, pr_number, review_type, head_sha):
+    """Record that a PR has been reviewed up to head_sha."""
+    with review_state_lock:
+        state = load_review_state()
+        state[get_review_state_key(owner, repo, pr_number, review_type)] = head_sha
+        with open(REVIEW_STATE_FILE, "w") as file:
+            json.dump(state, file, indent=2)
+
+def get_diff_to_review(owner, repo, pr, review_type, incremental, budget=MAX_DIFF_TOKEN_SIZE):
+    """Fetch the diff to review for a pull request.
+    
+    In incremental mode, only the changes pushed since the last reviewed head SHA are fetched.
+    The full PR diff is used the first time a PR is reviewed, or if the last reviewed SHA is gone.
+    
+    Returns:
+    - The filtered diff, or None if there is nothing new to review.
+    
+    Raises:
+    - ReviewError if the diff can't be downloaded.
+    """
+    pr_number = pr['number']
+    head_sha = pr['head']['sha']
+    if incremental:
+        last_sha = load_review_state().get(get_review_state_key(owner, repo, pr_number, review_type))
+        if last_sha == head_sha:
+            return None
+        if last_sha:
+            diff = get_compare_diff(owner, repo, last_sha, head_sha, budget)
+            if diff is not None:
+                print(colored(f"Reviewing changes since {last_sha[:7]}", "cyan"))
+                return diff
+            print(colored(f"Could not compare against {last_sha[:7]}, reviewing the full PR.", "yellow"))
+    return get_pull_request_diff(owner, repo, pr_number, budget)
 
 def count_tokens(token_list):
     return len(token_list)
 
-def encode_segments(tokens, TOKEN_SIZE):
+def get_tokenizer(model_to_use):
+    """Return the tokenizer for a model, loading it the first time it is needed.
+    
+    tiktoken is imported lazily so that it stays off the startup path, and each
+    encoding is only loaded once per process no matter how many reviews are run.
+    """
+    encoding_name = MODEL_ENCODINGS.get(model_to_use, DEFAULT_ENCODING)
+    with tokenizer_lock:
+        if encoding_name not in tokenizers:
+            import tiktoken
+            tokenizers[encoding_name] = tiktoken.get_encoding(encoding_name)
+    return tokenizers[encoding_name]
+
+def set_tokenizer_cache_dir(cache_dir):
+    """Point tiktoken at a directory of pre-downloaded BPE files so encodings load offline."""
+    if cache_dir:
+        os.environ['TIKTOKEN_CACHE_DIR'] = cache_dir
+
+def warm_tokenizer_cache(cache_dir):
+    """Download the BPE files for every known model into cache_dir."""
+    set_tokenizer_cache_dir(cache_dir)
+    for model_name in MODEL_ENCODINGS:
+        get_tokenizer(model_name)
+        print(colored(f"Cached tokenizer for {model_name}", "green"))
+
+def get_chunk_size(tokenizer, prompt_to_use, model_to_use):
+    """Work out how many diff tokens fit in a single request.
+    
+    The model's context window has to hold the system prompt, the diff chunk and
+    the MAX_TOKENS response, so the chunk size is whatever is left over, capped at TOKEN_SIZE.
+    """
+    context_size = MODEL_CONTEXT_SIZES.get(model_to_use, TOKEN_SIZE + MAX_TOKENS)
+    prompt_tokens = len(tokenizer.encode(prompt_to_use)) + MESSAGE_TOKEN_OVERHEAD
+    return max(1, min(TOKEN_SIZE, context_size - MAX_TOKENS - prompt_tokens))
+
+def encode_segments(tokens, tokenizer, chunk_size):
     """Chunk tokens into segments
     
+    Chunks are cut on hunk (@@) boundaries where possible, then on line
+    boundaries, and only split a line when a single line is larger than chunk_size.
+    
     Parameters:
-    - tokens: The tokens to chunk
-    - TOKEN_SIZE: The number of tokens per chunk
+    - tokens: The encoded tokens to chunk
+    - tokenizer: The tokenizer used to encode the tokens
+    - chunk_size: The maximum number of tokens per chunk
     
     Returns:
-    - A segment of size TOKEN_SIZE to send to CHATGPT
+    - A list of decoded segments of at most chunk_size tokens to send to CHATGPT
     """
+    if len(tokens) <= chunk_size:
+        return [tokenizer.decode(tokens)] if tokens else []
+
+    # Token positions where a new line (and a new hunk) starts
+    token_bytes = tokenizer.decode_tokens_bytes(tokens)
+    line_starts = [idx + 1 for idx, token in enumerate(token_bytes) if b'\n' in token]
+    hunk_starts = [idx for idx in line_starts if idx < len(token_bytes) and token_bytes[idx].startswith(b'@@')]
+
     segments = []
-    curr_len = 0
-    curr_segment = []
-    for token in tokens:
-        curr_len += 1
-        curr_segment.append(token)
-        if curr_len >= TOKEN_SIZE: # example chunk size
-            segments.append("".join(curr_segment))
-            curr_segment = []
-            curr_len = 0
-
-    if curr_segment:
-        segments.append("".join(curr_segment))
+    start = 0
+    while start < len(tokens):
+        end = start + chunk_size
+        if end < len(tokens):
+            # Prefer a hunk boundary in the back half of the chunk, then any line boundary
+            hunk_end = find_boundary(hunk_starts, start + chunk_size // 2, end)
+            line_end = find_boundary(line_starts, start, end)
+            end = hunk_end or line_end or end
+        segments.append(tokenizer.decode(tokens[start:end]))
+        start = end
     
     return segments
 
-def segment_diff_by_files(diff_text):
+def find_boundary(boundaries, lower, upper):
+    """Return the last boundary in the sorted list that is > lower and <= upper, or None."""
+    idx = bisect.bisect_right(boundaries, upper)
+    if idx and boundaries[idx - 1] > lower:
+        return boundaries[idx - 1]
+    return None
+
+def get_file_diffs(diff):
+    """Return the parsed FileDiff records for a diff given as text or as records."""
+    if isinstance(diff, str):
+        return list(parse_diff(split_lines([diff])))
+    return list(diff)
+
+def segment_diff_by_files(diff):
     """
     Segment the diff by individual files.
     
     Parameters:
-    - diff_text: The entire diff text.
+    - diff: The entire diff text, or a list of FileDiff records that have already been parsed.
     
     Returns:
     - A list of segments, each segment corresponding to a file's diff.
     """
+    return [file_diff.text for file_diff in get_file_diffs(diff)]
+
+def plan_review(diff, tokenizer, prompt_to_use, model_to_use, budget=MAX_DIFF_TOKEN_SIZE, pack=True, router=None):
+    """Work out which files to review before any request is made.
     
-    # Split the diff text by sections
-    sections = re.split(r'\ndiff --git', diff_text)
-    
-    # Add back the "diff --git" prefix removed during splitting (except for the first section)
-    sections = [sections[0]] + ['diff --git' + section for section in sections[1:]]
+    Files are first compacted (see diff_compactor.py) and files matching the SKIP_PATHS
+    rules are excluded. Files that repeat an earlier file's changes are marked as its
+    duplicates (see diff_dedup.py) and aren't sent. Every other file is tokenized once. If the diff is over the token
+    budget, files are prioritised (source before lockfiles and generated code, then the
+    files with the highest share of added lines) and the budget is handed out in that order. The file
+    that crosses the budget is truncated if enough budget is left, the rest are skipped.
+    Files that were cut short while downloading (see stream_diff) are truncated, or skipped
+    if none of their lines were kept.
+    If a router is given, each file is sent to the backend and model it picks, otherwise
+    to model_to_use. If pack is set, small files going to the same model are grouped so
+    they can share requests.
     
-    return sections
+    Returns:
+    - A dict with the planned files (in diff order) and the estimated requests, tokens, cost and time.
+    """
+    prompt_tokens = len(tokenizer.encode(prompt_to_use)) + MESSAGE_TOKEN_OVERHEAD
+    files = []
+    kept = []
+    for file_diff in get_file_diffs(diff):
+        text = file_diff.text
+        if not text.strip():
+            continue  # Skip empty segments
+        planned = {
+            "filename": file_diff.filename,
+            "text": text,
+            "tokens": [],
+            "token_count": 0,
+            "saved_tokens": 0,
+            "low_priority": is_low_priority(file_diff),
+            "density": added_line_density(file_diff),
+            "action": "review"
+        }
+        files.append(planned)
+        if file_diff.dropped_lines and not file_diff.hunks:
+            # Past the budget before the download got to it
+            planned["action"] = "skip"
+            continue
+        compacted = file_diff
+        if diff_compactor is not None:
+            compacted = diff_compactor.compact(file_diff)
+            if diff_compactor.should_skip(file_diff) or (file_diff.hunks and not compacted.hunks):
+                planned["action"] = "exclude"
+                continue
+        kept.append((planned, file_diff, compacted))
+
+    # Changes repeated across files are only reviewed once
+    if diff_deduplicator is not None:
+        deduplicated = diff_deduplicator.deduplicate([compacted for _, _, compacted in kept])
+        for (planned, file_diff, _), result in zip(kept, deduplicated):
+            if result["duplicate_of"] is not None:
+                planned["action"] = "duplicate"
+                planned["duplicate_of"] = kept[result["duplicate_of"]][0]
+                planned["similarity"] = result["similarity"]
+                metrics.increment("duplicate_files")
+            metrics.increment("duplicate_hunks", result["shared_hunks"])
+        kept = [(planned, file_diff, result["file_diff"]) for (planned, file_diff, _), result in zip(kept, deduplicated)]
+
+    for planned, file_diff, compacted in kept:
+        if planned["action"] == "duplicate":
+            continue
+        with metrics.phase("tokenize"):
+            if compacted is not file_diff and compacted.text != planned["text"]:
+                planned["saved_tokens"] = len(tokenizer.encode(planned["text"]))
+                planned["text"] = compacted.text
+            planned["tokens"] = tokenizer.encode(planned["text"])
+        planned["token_count"] = len(planned["tokens"])
+        if planned["saved_tokens"]:
+            planned["saved_tokens"] -= planned["token_count"]
 
-def review_code_with_chatgpt(diff, chatgpt_api_key, prompt_to_use, args):
+    remaining = budget
+    candidates = [planned for planned in files if planned["action"] == "review"]
+    for planned in sorted(candidates, key=lambda f: (f["low_priority"], -f["density"], -f["token_count"])):
+        if planned["token_count"] <= remaining:
+            remaining -= planned["token_count"]
+        elif remaining >= MIN_TRUNCATED_TOKENS:
+            planned["action"] = "truncate"
+            planned["tokens"] = planned["tokens"][:remaining]
+            planned["text"] = tokenizer.decode(planned["tokens"])
+            remaining = 0
+        else:
+            planned["action"] = "skip"
+    for planned, file_diff, _ in kept:
+        if planned["action"] == "review" and file_diff.dropped_lines:
+            planned["action"] = "truncate"
+    for planned in files:
+        if planned["action"] == "duplicate" and planned["duplicate_of"]["action"] == "skip":
+            planned["action"] = "skip"
+
+    reviewed = [planned for planned in files if planned["action"] in ("review", "truncate", "duplicate")]
+    routes = {}
+    for idx, planned in enumerate(reviewed):
+        if planned["action"] == "duplicate":
+            continue
+        if router is not None:
+            planned["backend"], planned["model"] = router.route(planned["filename"], planned["token_count"],
+                                                                planned["low_priority"])
+        else:
+            planned["backend"], planned["model"] = DEFAULT_BACKEND, model_to_use
+        routes.setdefault((planned["backend"], planned["model"]), []).append(idx)
+    for planned in reviewed:
+        if planned["action"] == "duplicate":
+            planned["backend"], planned["model"] = planned["duplicate_of"]["backend"], planned["duplicate_of"]["model"]
+
+    groups = []
+    requests_needed = 0
+    cost = 0
+    backend_usage = {}      # Backend name -> [requests, prompt and completion tokens], to estimate the time
+    for (route_backend, route_model), indexes in routes.items():
+        route_chunk_size = get_chunk_size(tokenizer, prompt_to_use, route_model)
+        route_files = [reviewed[idx] for idx in indexes]
+        route_groups = pack_files(route_files, route_chunk_size) if pack else [[idx] for idx in range(len(route_files))]
+        route_requests = sum(math.ceil(len(route_files[group[0]]["tokens"]) / route_chunk_size) if len(group) == 1 else 1
+                             for group in route_groups)
+        groups.extend([indexes[idx] for idx in group] for group in route_groups)
+        requests_needed += route_requests
+        prompt_price, completion_price = MODEL_PRICES.get(route_model, (0, 0))
+        route_prompt_tokens = sum(len(planned["tokens"]) for planned in route_files) + route_requests * prompt_tokens
+        # Worst case: every request uses its full MAX_TOKENS response
+        cost += (route_prompt_tokens * prompt_price + route_requests * MAX_TOKENS * completion_price) / 1000
+        usage = backend_usage.setdefault(route_backend, [0, 0])
+        usage[0] += route_requests
+        usage[1] += route_prompt_tokens + route_requests * MAX_TOKENS
+    groups.sort(key=lambda group: group[0])
+    diff_tokens = sum(len(planned["tokens"]) for planned in reviewed)
+    saved_tokens = sum(planned["saved_tokens"] for planned in files)
+    metrics.increment("compaction_tokens_saved", saved_tokens)
+    return {
+        "files": files,
+        "reviewed": reviewed,
+        "groups": groups,
+        "budget": budget,
+        "total_tokens": sum(planned["token_count"] for planned in files),
+        "diff_tokens": diff_tokens,
+        "saved_tokens": saved_tokens,
+        "excluded": [planned["filename"] for planned in files if planned["action"] == "exclude"],
+        "duplicates": sum(1 for planned in reviewed if planned["action"] == "duplicate"),
+        "requests": requests_needed,
+        "routed": router is not None,
+        "cost": cost,
+        # Backends have their own limits and are used at the same time
+        "seconds": max([estimate_backend_seconds(name, *usage) for name, usage in backend_usage.items()] + [0])
+    }
+
+def estimate_backend_seconds(name, requests_needed, tokens_needed):
+    """Estimate how long a backend's rate limits take to let requests_needed requests and tokens_needed tokens through."""
+    if name == DEFAULT_BACKEND or name not in backends:
+        max_requests, max_tokens = RATE_LIMIT_REQUESTS, RATE_LIMIT_TOKENS
+    else:
+        max_requests, max_tokens = backends[name].rate_limiter.max_requests, backends[name].rate_limiter.max_tokens
+    return 60 * max(requests_needed / max_requests if max_requests else 0, tokens_needed / max_tokens if max_tokens else 0)
+
+def format_plan(plan):
+    """Render a review plan as text for -dry-run."""
+    lines = []
+    for planned in plan["files"]:
+        action = planned["action"]
+        if action == "truncate":
+            action = f"truncate to {len(planned['tokens'])}"
+        if action == "duplicate":
+            similarity = "" if planned["similarity"] == 1 else f", {planned['similarity']:.0%} similar"
+            lines.append(f"{action:>18}  {'':>14}  {planned['filename']} (of {planned['duplicate_of']['filename']}{similarity})")
+            continue
+        if action == "exclude":
+            lines.append(f"{action:>18}  {'':>14}  {planned['filename']} (SKIP_PATHS or nothing left after compaction)")
+            continue
+        note = " (lockfile/generated)" if planned["low_priority"] else ""
+        if planned["saved_tokens"]:
+            note += f" (compacted, -{planned['saved_tokens']} tokens)"
+        if plan["routed"] and "model" in planned:
+            note += f" [{planned['backend']}/{planned['model']}]"
+        lines.append(f"{action:>18}  {planned['token_count']:>7} tokens  {planned['filename']}{note}")
+    lines.append("")
+    lines.append(f"Diff tokens: {plan['total_tokens']} (budget {plan['budget']}, {plan['diff_tokens']} to review)")
+    if plan["saved_tokens"] or plan["excluded"]:
+        lines.append(f"Compaction saved {plan['saved_tokens']} tokens and excluded {len(plan['excluded'])} files")
+    if plan["duplicates"]:
+        lines.append(f"Duplicates: {plan['duplicates']} files share the review of another file")
+    lines.append(f"Requests: {plan['requests']}")
+    lines.append(f"Estimated cost: up to ${plan['cost']:.2f}")
+    lines.append(f"Estimated time under rate limits: at least {plan['seconds']:.0f}s")
+    return "\n".join(lines)
+
+def format_dry_run(diff, args):
+    """Plan the review of a diff for -dry-run. With several review types, it also shows the requests and cost of all of them."""
+    model_to_use = args.model if args.model is not None else model
+    tokenizer = get_tokenizer(model_to_use)
+    prompts_to_use = [prompts[review_type] for review_type in args.review_types]
+    plan = plan_review(diff, tokenizer, get_sizing_prompt(tokenizer, prompts_to_use), model_to_use, args.budget,
+                       not args.no_pack, get_model_router(args))
+    text = format_plan(plan)
+    if len(prompts_to_use) > 1:
+        text += (f"\nReview types: {', '.join(args.review_types)}, {plan['requests'] * len(prompts_to_use)} requests "
+                 f"costing up to ${plan['cost'] * len(prompts_to_use):.2f} in all")
+    return text
+
+def print_plan_warnings(plan):
+    """Let the user know when files were truncated or skipped to stay within the budget."""
+    skipped = [planned["filename"] for planned in plan["files"] if planned["action"] == "skip"]
+    truncated = [planned["filename"] for planned in plan["files"] if planned["action"] == "truncate"]
+    if truncated:
+        print(colored(f"Over the {plan['budget']} token budget, truncated: {', '.join(truncated)}", "yellow"))
+    if skipped:
+        print(colored(f"Over the {plan['budget']} token budget, skipped: {', '.join(skipped)}", "yellow"))
+    if plan["excluded"]:
+        print(colored(f"Excluded by SKIP_PATHS or compaction: {', '.join(plan['excluded'])}", "yellow"))
+
+class ReviewError(Exception):
+    """Raised when the OpenAI API returns an error for a review request."""
+    pass
+
+def get_error_message(response):
+    """Get the error message from a failed OpenAI response."""
+    try:
+        return response.json().get('error', {}).get('message', 'Unknown error')
+    except ValueError:
+        return f"HTTP {response.status_code}"
+
+def request_review(content, backend, prompt_to_use, model_to_use, estimated_tokens, on_delta=None, diff_first=False):
     """
-    Get a code review from ChatGPT using the provided diff.
-    This version of the function segments the diff by files.
+    Send one chat completion request for a piece of diff.
+    With diff_first, the diff is sent before the prompt, so the requests of several review types
+    for the same diff share a prefix that the provider can cache.
+    
+    Returns:
+    - The completion response, shaped the same whether or not it was streamed.
     """
-    headers = {
-        "Authorization": f"Bearer {chatgpt_api_key}",
-        "Content-Type": "application/json"
+    message = {
+        "role": "user",
+        "content": content
+    }
+    system_message = {
+        "role": "system",
+        "content": prompt_to_use
+    }
+    
+    data = {
+        "model": model_to_use,
+        "messages": [message, system_message] if diff_first else [system_message, message],
+        "max_tokens": MAX_TOKENS
     }
+    if on_delta is not None:
+        data["stream"] = True
+        # Ask for the token usage in the last chunk of the stream
+        data["stream_options"] = {"include_usage": True}
+
+    response = backend.complete(data, estimated_tokens, stream=on_delta is not None)
+    if response.status_code != 200:
+        raise ReviewError(get_error_message(response))
+    if on_delta is not None:
+        completion = read_streamed_completion(response, on_delta)
+    else:
+        completion = response.json()
+    metrics.record_usage(completion.get('usage'))
+    return completion
+
+def review_file_segment(file_segment, tokenizer, backend, prompt_to_use, model_to_use, review_cache=None, tokens=None,
+                        on_delta=None, chunk_size=None, diff_first=False, finished_chunks=None):
+    """
+    Review a single file's diff, chunking it under the token limit.
+    If a review cache is given, a previous review of the same diff is reused.
+    If on_delta is given, the completions are streamed and on_delta is called with each piece of text as it arrives.
+    If chunk_size is given it is used instead of the chunk size for prompt_to_use, so that several
+    review types split the file into the same chunks (see submit_reviews).
+    If finished_chunks is given, the response of each chunk is added to it as it finishes. When the
+    review is retried with the same list, those chunks are neither sent nor streamed again. A chunk
+    that fails after part of it was streamed keeps that part, followed by STREAM_RETRY_NOTE, so the
+    streamed text always matches the returned review.
+    
+    Returns:
+    - The review text for the file.
+    """
+    if review_cache is not None:
+        cache_key = ReviewCache.make_key(file_segment, prompt_to_use, model_to_use, MAX_TOKENS)
+        cached_review = review_cache.get(cache_key)
+        metrics.increment("cache_hits" if cached_review is not None else "cache_misses")
+        if cached_review is not None:
+            if on_delta is not None:
+                on_delta(cached_review)
+            return cached_review
+
+    if tokens is None:
+        tokens = tokenizer.encode(file_segment)
+
+    # Chunk diff into segments that fit in the model's context next to the prompt and response
+    if chunk_size is None:
+        chunk_size = get_chunk_size(tokenizer, prompt_to_use, model_to_use)
+    segments = encode_segments(tokens, tokenizer, chunk_size)
+    # Reserve the worst case for each request: a full chunk, the prompt and the full response
+    estimated_tokens = min(chunk_size, len(tokens)) + len(tokenizer.encode(prompt_to_use)) + MESSAGE_TOKEN_OVERHEAD + MAX_TOKENS
+    
+    # Send segments and collect responses, picking up after the chunks an earlier attempt finished
+    responses = finished_chunks if finished_chunks is not None else []
+    sent = sum(1 for response in responses if not response.get("partial"))
+    for segment in segments[sent:]:
+        streamed = []
+        chunk_on_delta = None
+        if on_delta is not None:
+            chunk_on_delta = lambda delta: (streamed.append(delta), on_delta(delta))
+        try:
+            responses.append(request_review(segment, backend, prompt_to_use, model_to_use, estimated_tokens, chunk_on_delta,
+                                            diff_first))
+        except Exception:
+            if streamed:
+                # Already written out, so it stays part of the review
+                on_delta(STREAM_RETRY_NOTE)
+                responses.append({"choices": [{"message": {"content": "".join(streamed) + STREAM_RETRY_NOTE}}],
+                                  "partial": True})
+            raise
+
+    # Aggregate responses for the current file segment
+    review = get_full_review(responses)
+    if review_cache is not None:
+        # The cut off text of a retried chunk is only kept in what was already streamed
+        review_cache.set(cache_key, get_full_review([response for response in responses if not response.get("partial")]))
+    return review
+
+def review_packed_files(files, tokenizer, backend, prompt_to_use, model_to_use, review_cache=None, chunk_size=None,
+                        diff_first=False):
+    """
+    Review several small files in a single request.
+    
+    The model starts the review of each file with 'File: [name]', which is used to split
+    the response back into one review per file. Any file missing from the response is
+    reviewed on its own instead.
+    
+    Returns:
+    - The review text of each file, in the order of files.
+    """
+    reviews = [None] * len(files)
+    cache_keys = [ReviewCache.make_key(f["text"], prompt_to_use, model_to_use, MAX_TOKENS) for f in files]
+    if review_cache is not None:
+        for idx, cache_key in enumerate(cache_keys):
+            reviews[idx] = review_cache.get(cache_key)
+            metrics.increment("cache_hits" if reviews[idx] is not None else "cache_misses")
+    missing = [idx for idx, review in enumerate(reviews) if review is None]
+
+    if len(missing) > 1:
+        content = "\n\n".join(files[idx]["text"] for idx in missing)
+        estimated_tokens = (sum(len(files[idx]["tokens"]) for idx in missing) + len(tokenizer.encode(prompt_to_use))
+                            + MESSAGE_TOKEN_OVERHEAD + MAX_TOKENS)
+        review = get_full_review([request_review(content, backend, prompt_to_use, model_to_use, estimated_tokens,
+                                                 diff_first=diff_first)])
+        metrics.increment("packed_requests")
+        split_reviews = split_review_by_file(review, [files[idx]["filename"] for idx in missing])
+        for idx in missing:
+            reviews[idx] = split_reviews.get(files[idx]["filename"])
+            if reviews[idx] is not None and review_cache is not None:
+                review_cache.set(cache_keys[idx], reviews[idx])
+
+    for idx, review in enumerate(reviews):
+        if review is None:
+            if len(missing) > 1:
+                metrics.increment("pack_fallbacks")
+            reviews[idx] = review_file_segment(files[idx]["text"], tokenizer, backend, prompt_to_use, model_to_use,
+                                               None, files[idx]["tokens"], chunk_size=chunk_size, diff_first=diff_first)
+            if review_cache is not None:
+                review_cache.set(cache_keys[idx], reviews[idx])
+    return reviews
+
+def split_review_by_file(review, filenames):
+    """
+    Split a review of several files into one review per file, using the 'File: [name]' headings.
+    
+    Returns:
+    - A dict of filename to its review, for the files that could be found in the review.
+    """
+    split_reviews = {}
+    for section in re.split(r'(?im)^(?=[ \t#>*_`-]*File:)', review):
+        heading = re.match(r'[ \t#>*_`-]*File:\s*(.*)', section)
+        if heading is None:
+            continue
+        filename = match_filename(heading.group(1).strip('[]`*_"\' \t'), filenames)
+        if filename is None:
+            continue
+        file_review = section.strip()
+        split_reviews[filename] = split_reviews[filename] + "\n\n" + file_review if filename in split_reviews else file_review
+    return split_reviews
+
+def match_filename(name, filenames):
+    """Find the file a review heading refers to, allowing for a shortened or longer path."""
+    if name in filenames:
+        return name
+    for filename in filenames:
+        if filename and (filename.endswith("/" + name) or name.endswith("/" + filename)):
+            return filename
+    basename = os.path.basename(name)
+    matches = [filename for filename in filenames if filename and os.path.basename(filename) == basename]
+    return matches[0] if len(matches) == 1 else None
+
+def pack_files(files, capacity):
+    """
+    Group small files into shared requests, first-fit decreasing by token count.
+    
+    Each group holds at most capacity tokens of diff and MAX_TOKENS // PACK_REVIEW_TOKENS
+    files, so that the response has room for every file's review. Files that don't fit
+    with others are left in a group of their own.
     
+    Returns:
+    - A list of groups, each a list of indexes into files, ordered by their first file.
+    """
+    max_files = max(1, MAX_TOKENS // PACK_REVIEW_TOKENS)
+    bins = []
+    order = sorted(range(len(files)), key=lambda idx: len(files[idx]["tokens"]), reverse=True)
+    for idx in order:
+        size = len(files[idx]["tokens"]) + PACK_SEPARATOR_TOKENS
+        for packed in bins:
+            if packed["free"] >= size and len(packed["files"]) < max_files:
+                packed["free"] -= size
+                packed["files"].append(idx)
+                break
+        else:
+            bins.append({"free": capacity - size, "files": [idx]})
+    groups = [sorted(packed["files"]) for packed in bins]
+    return sorted(groups, key=lambda group: group[0])
+
+def get_rate_limiter():
+    """Return the rate limiter of the default OpenAI backend, shared by every review in this process."""
+    global rate_limiter
+    with rate_limiter_lock:
+        if rate_limiter is None:
+            rate_limiter = RateLimiter(RATE_LIMIT_REQUESTS, RATE_LIMIT_TOKENS, MAX_RETRIES, http_client=http_client, metrics=metrics,
+                                       timeout=COMPLETION_TIMEOUT)
+    return rate_limiter
+
+def get_backend(name, chatgpt_api_key):
+    """Return a backend by name. The default backend is OPEN_AI_URL with the configured OpenAI key."""
+    with backends_lock:
+        if name not in backends:
+            if name != DEFAULT_BACKEND:
+                raise ReviewError(f"Unknown backend {name}, add it to BACKENDS in config.json")
+            backends[name] = Backend(DEFAULT_BACKEND, OPEN_AI_URL, chatgpt_api_key, get_rate_limiter())
+        return backends[name]
+
+def configure_backends(config):
+    """Set up the extra backends (BACKENDS) and the model routing rules (ROUTING) from config.json.
+    
+    Each backend has a 'base_url' of an OpenAI-compatible API, and optionally an 'api_key' (or the
+    name of an environment variable holding it in 'api_key_env'), its 'requests_per_minute' and
+    'tokens_per_minute' limits (none if they are missing, until the backend reports its limits in
+    x-ratelimit headers), and the 'context_sizes' and 'prices' of models that aren't listed
+    in MODEL_CONTEXT_SIZES and MODEL_PRICES.
+    """
+    global routing_rules
+    for name, settings in (config.get('BACKENDS') or {}).items():
+        api_key = settings.get('api_key') or os.environ.get(settings.get('api_key_env') or '')
+        MODEL_CONTEXT_SIZES.update(settings.get('context_sizes') or {})
+        MODEL_PRICES.update({model_name: tuple(prices) for model_name, prices in (settings.get('prices') or {}).items()})
+        # A local server usually has no limits and sends no x-ratelimit headers, so none are assumed
+        backend_rate_limiter = RateLimiter(settings.get('requests_per_minute'), settings.get('tokens_per_minute'),
+                                           MAX_RETRIES, http_client=http_client, metrics=metrics, timeout=COMPLETION_TIMEOUT)
+        backends[name] = Backend(name, get_completions_url(settings), api_key, backend_rate_limiter)
+    routing_rules = config.get('ROUTING') or []
+    for rule in routing_rules:
+        backend_name = rule.get('backend', DEFAULT_BACKEND)
+        if backend_name != DEFAULT_BACKEND and backend_name not in backends:
+            raise ValueError(f"Routing rule {rule} uses the backend {backend_name}, which isn't in BACKENDS")
+    # Check the rules now rather than on the first review
+    ModelRouter(routing_rules, model)
+
+def get_model_router(args):
+    """Return the router for a review, or None if -model picks the model of every file."""
+    if getattr(args, 'model', None) is not None or not routing_rules:
+        return None
+    return ModelRouter(routing_rules, model)
+
+def submit_review(diff, chatgpt_api_key, prompt_to_use, args, executor, review_cache=None, stream_writer=None, journal=None):
+    """
+    Plan a review and queue each of its files on the executor.
+    If a stream writer is given, each file's review is written to it as it streams in.
+    If a journal is given, each file's review (or failure) is recorded in it, and files
+    it already has a review for are not reviewed again.
+    
+    Returns:
+    - A list of futures, one per reviewed file, in the original file order.
+    """
+    return submit_reviews(diff, chatgpt_api_key, [prompt_to_use], args, executor, review_cache, [stream_writer], [journal])[0]
+
+def get_sizing_prompt(tokenizer, prompts_to_use):
+    """Return the longest of the prompts, which the diff is chunked for when it is reviewed with all of them."""
+    return max(prompts_to_use, key=lambda prompt_to_use: len(tokenizer.encode(prompt_to_use)))
+
+def submit_reviews(diff, chatgpt_api_key, prompts_to_use, args, executor, review_cache=None, stream_writers=None, journals=None):
+    """
+    Plan a review once and queue each of its files on the executor for every prompt (see -type).
+    
+    The diff is compacted, tokenized, chunked and packed once, sized for the longest prompt so the
+    same chunks fit next to each of them. With several prompts the chunk is sent before the prompt
+    and the requests of every prompt for a chunk are queued one after the other, so a provider that
+    caches prompt prefixes can reuse the chunk across review types.
+    
+    Parameters:
+    - stream_writers / journals: A stream writer and a journal (or None) for each prompt, see submit_review.
+    
+    Returns:
+    - A list of futures for each prompt, one per reviewed file, in the original file order.
+    """
+    model_to_use = args.model if args.model is not None else model
     # Get token count 
-    tokenizer = tiktoken.get_encoding("gpt2")
+    tokenizer = get_tokenizer(model_to_use)
+    stream_writers = stream_writers or [None] * len(prompts_to_use)
+    journals = journals or [None] * len(prompts_to_use)
+    fan_out = len(prompts_to_use) > 1
+    sizing_prompt = get_sizing_prompt(tokenizer, prompts_to_use)
+
+    # Segment the diff by files and fit them into the token budget
+    plan = plan_review(diff, tokenizer, sizing_prompt, model_to_use, getattr(args, 'budget', MAX_DIFF_TOKEN_SIZE),
+                       not getattr(args, 'no_pack', False), get_model_router(args))
+    print_plan_warnings(plan)
+    files = plan["reviewed"]
+    for planned in files:
+        planned["journal_key"] = ReviewJournal.make_key(planned["text"], planned["model"])
+    for journal in journals:
+        if journal is not None:
+            journal.order = [planned["journal_key"] for planned in files]
+    all_futures = [[None] * len(files) for _ in prompts_to_use]
+    for group in plan["groups"]:
+        # Every file of a group is routed to the same backend and model
+        backend = get_backend(files[group[0]]["backend"], chatgpt_api_key)
+        file_model = files[group[0]]["model"]
+        chunk_size = get_chunk_size(tokenizer, sizing_prompt, file_model) if fan_out else None
+        for prompt_to_use, futures, stream_writer, journal in zip(prompts_to_use, all_futures, stream_writers, journals):
+            # Files reviewed by an earlier run, see -resume
+            for idx in group:
+                resumed = journal.get_review(files[idx]["journal_key"]) if journal is not None else None
+                if resumed is not None:
+                    futures[idx] = Future()
+                    futures[idx].set_result(resumed)
+                    if stream_writer is not None:
+                        stream_writer.write(idx, resumed)
+                    metrics.increment("resumed_files")
+            remaining = [idx for idx in group if futures[idx] is None]
+
+            if len(remaining) == 1:
+                idx = remaining[0]
+                on_delta = functools.partial(stream_writer.write, idx) if stream_writer is not None else None
+                # on_delta is passed in by run_review_task, which keeps track of what was streamed
+                review_function = functools.partial(review_file_segment, files[idx]["text"], tokenizer, backend, prompt_to_use,
+                                                    file_model, review_cache, files[idx]["tokens"], chunk_size=chunk_size,
+                                                    diff_first=fan_out, finished_chunks=[])
+                futures[idx] = executor.submit(run_review_task, review_function, [files[idx]], journal, on_delta=on_delta)
+            elif remaining:
+                # One request for the group, with a future per file so they are collected like any other file
+                review_function = functools.partial(review_packed_files, [files[idx] for idx in remaining], tokenizer, backend,
+                                                    prompt_to_use, file_model, review_cache, chunk_size, fan_out)
+                # Used if the packed request fails, so one bad file doesn't fail the others
+                file_functions = [functools.partial(review_file_segment, files[idx]["text"], tokenizer, backend, prompt_to_use,
+                                                    file_model, review_cache, files[idx]["tokens"], None, chunk_size, fan_out, [])
+                                  for idx in remaining]
+                group_future = executor.submit(run_review_task, review_function, [files[idx] for idx in remaining], journal,
+                                               file_functions=file_functions)
+                for idx in remaining:
+                    futures[idx] = Future()
+                group_future.add_done_callback(functools.partial(
+                    resolve_packed_futures, [futures[idx] for idx in remaining], remaining, stream_writer))
+
+    # Duplicates get the review of their representative, which comes before them in the diff
+    positions = {id(planned): idx for idx, planned in enumerate(files)}
+    for futures, stream_writer, journal in zip(all_futures, stream_writers, journals):
+        for idx, planned in enumerate(files):
+            if planned["action"] != "duplicate":
+                continue
+            futures[idx] = Future()
+            resumed = journal.get_review(planned["journal_key"]) if journal is not None else None
+            if resumed is not None:
+                futures[idx].set_result(resumed)
+                if stream_writer is not None:
+                    stream_writer.write(idx, resumed)
+                continue
+            futures[positions[id(planned["duplicate_of"])]].add_done_callback(functools.partial(
+                resolve_duplicate_future, futures[idx], idx, planned, stream_writer, journal))
+        if stream_writer is not None:
+            for idx, future in enumerate(futures):
+                future.add_done_callback(lambda _, idx=idx, stream_writer=stream_writer: stream_writer.finish(idx))
+    return all_futures
+
+def run_review_task(review_function, files, journal=None, on_delta=None, file_functions=None):
+    """
+    Run the review of a file, or of a packed group of files, retrying it if it fails.
+    Every outcome is recorded in the journal, if there is one.
     
-    # Segment the diff by files
-    file_segments = segment_diff_by_files(diff)
+    Parameters:
+    - review_function: Reviews the files, returning a review (or a list of reviews for a packed group).
+    - files: The planned files that review_function reviews.
+    - on_delta: Passed on to review_function to stream the review. Text streamed by a failed
+      attempt stays in the review, see review_file_segment.
+    - file_functions: For a packed group, a function reviewing each file on its own. If the
+      packed request fails, the files are retried one by one with them.
     
-    # Store aggregated reviews
-    aggregated_reviews = []
-    rate_limiter = RateLimiter(3, 10000)
-    segment_loader = tqdm(total=len(file_segments), position=0, leave=True, desc=colored(f'Reviewing Code', "white")) 
-    for file_segment in file_segments:
-        if not file_segment.strip():
-            continue  # Skip empty segments
+    Returns:
+    - What review_function returns. A file that still fails after FILE_REVIEW_ATTEMPTS (or after
+      a completion timed out) gets an error message as its review, so one file can't fail the whole review.
+    """
+    packed = file_functions is not None
+    streamed = []
+    if on_delta is not None:
+        review_function = functools.partial(review_function, on_delta=lambda delta: (streamed.append(delta), on_delta(delta)))
+    for attempt in range(1, FILE_REVIEW_ATTEMPTS + 1):
+        try:
+            result = review_function()
+            break
+        except Exception as e:
+            metrics.increment("file_review_failures")
+            if journal is not None:
+                for planned in files:
+                    journal.record_failure(planned["journal_key"], planned["filename"], e, attempt)
+            if packed:
+                metrics.increment("pack_fallbacks", len(files))
+                return [run_review_task(file_function, [planned], journal)
+                        for file_function, planned in zip(file_functions, files)]
+            # A completion that timed out may still be generated and billed, so it isn't sent again
+            if attempt == FILE_REVIEW_ATTEMPTS or isinstance(e, requests.ReadTimeout):
+                failed = f"File: {files[0]['filename']}\n{FAILED_REVIEW_MESSAGE}: {e}"
+                if on_delta is not None:
+                    on_delta(("\n\n" if streamed else "") + failed)
+                # Whatever was streamed before the failure stays in the review, as it does in the output
+                return "".join(streamed) + ("\n\n" if streamed else "") + failed
+    if journal is not None:
+        for planned, review in zip(files, result if packed else [result]):
+            journal.record_review(planned["journal_key"], planned["filename"], review)
+    return result
 
-        tokens = tokenizer.encode(file_segment)
-        token_strings = tokenizer.decode(tokens)
+def review_failed(review):
+    """Return True if the whole review, or the review of any of its files, failed."""
+    return review.startswith(FAILED_REVIEW_MESSAGE) or f"\n{FAILED_REVIEW_MESSAGE}: " in review
 
-        # Chunk diff into segments under token limit
-        segments = encode_segments(token_strings, TOKEN_SIZE)
-        
-        # Send segments and collect responses
-        responses = []
-        totalTokenSent = 0
-        model_to_use = args.model if args.model is not None else model
-        for segment in segments:
-            totalTokenSent += len(segment)
-            
-            message = {
-                "role": "user",
-                "content": segment
-            }
-            
-            data = {
-                "model": model_to_use,
-                "messages": [
-                    {
-                        "role": "system",
-                        "content": prompt_to_use
-                    },
-                    message
-                ],
-                "max_tokens": MAX_TOKENS
-            }
-
-            response = rate_limiter.make_request(OPEN_AI_URL, method="POST", headers=headers, data=data)
-            if response.status_code not in [429, 200]:
-                error_msg = response.json().get('error', {}).get('message', 'Unknown error')
-                return f"Review failed due to an error: {error_msg}"
-            responses.append(response.json())
-
-        # Aggregate responses for the current file segment
-        aggregated_reviews.append(get_full_review(responses))
-        # Update the loader
-        segment_loader.update(1)
-    
-    # Return the aggregated review
-    segment_loader.close()
-    return "\n\n".join(aggregated_reviews)
+def open_journal(owner, repo, pr, prompt_to_use, resume):
+    """Open the journal of a PR at its head SHA. With resume, the files it has reviews for are reused."""
+    path = ReviewJournal.make_path(JOURNAL_DIR, owner, repo, pr['number'], pr['head']['sha'], prompt_to_use)
+    return ReviewJournal(path, resume)
+
+def close_journals(journals):
+    for journal in journals:
+        journal.close()
+
+def resolve_packed_futures(file_futures, group, stream_writer, group_future):
+    """Hand the result of a packed request out to the future of each of its files."""
+    if group_future.cancelled():
+        for file_future in file_futures:
+            file_future.cancel()
+        return
+    error = group_future.exception()
+    for position, (idx, file_future) in enumerate(zip(group, file_futures)):
+        try:
+            if error is not None:
+                file_future.set_exception(error)
+            else:
+                review = group_future.result()[position]
+                if stream_writer is not None:
+                    stream_writer.write(idx, review)
+                file_future.set_result(review)
+        except InvalidStateError:
+            pass  # The file's future was cancelled while the request was running
+
+def share_review(review, planned):
+    """Turn the review of a duplicate's representative into the review of the duplicate."""
+    representative = planned["duplicate_of"]["filename"]
+    if planned["similarity"] == 1:
+        note = f"[Duplicate of {representative}: the same change, reviewed once]"
+    else:
+        note = f"[Near-duplicate of {representative} ({planned['similarity']:.0%} similar), reviewed as {representative}]"
+    return f"File: {planned['filename']}\n{note}\n{strip_file_headings(review)}"
+
+def strip_file_headings(review):
+    """Remove the 'File: [name]' heading lines from the review of a file."""
+    return re.sub(r'(?im)^[ \t#>*_`-]*File:.*\n?', '', review).strip()
+
+def iter_combined_reviews(review_types, journals):
+    """
+    Combine the journaled reviews of several review types into one review per file, in diff order.
+    With a single review type its reviews are yielded as they are.
+    
+    Returns:
+    - A generator of file reviews, each with a section per review type.
+    """
+    if len(journals) == 1:
+        yield from journals[0].iter_reviews()
+        return
+    # Every journal shares the same file keys, so each file is looked up by key rather than by position
+    for key in journals[0].order:
+        file_reviews = [journal.get_file_review(key) for journal in journals]
+        recorded = [file_review for file_review in file_reviews if file_review is not None]
+        if not recorded:
+            continue
+        sections = [f"{review_type.capitalize()} review:\n"
+                    + (strip_file_headings(file_review[1]) if file_review is not None else "No review was recorded.")
+                    for review_type, file_review in zip(review_types, file_reviews)]
+        yield f"File: {recorded[0][0]}\n" + "\n\n".join(sections)
+
+def resolve_duplicate_future(file_future, idx, planned, stream_writer, journal, representative_future):
+    """Give a duplicate file the review of its representative once it is done."""
+    if representative_future.cancelled():
+        file_future.cancel()
+        return
+    try:
+        error = representative_future.exception()
+        if error is not None:
+            file_future.set_exception(error)
+            return
+        review = representative_future.result()
+        if review_failed(review):
+            error = f"the review of {planned['duplicate_of']['filename']} failed"
+            review = f"File: {planned['filename']}\n{FAILED_REVIEW_MESSAGE}: {error}"
+            if journal is not None:
+                journal.record_failure(planned["journal_key"], planned["filename"], error, 1)
+        else:
+            review = share_review(review, planned)
+            if journal is not None:
+                journal.record_review(planned["journal_key"], planned["filename"], review)
+        if stream_writer is not None:
+            stream_writer.write(idx, review)
+        file_future.set_result(review)
+    except InvalidStateError:
+        pass  # The file's future was cancelled while its representative was being reviewed
+
+def collect_review(futures, description='Reviewing Code', show_progress=True, cancelled=None):
+    """
+    Wait for the file reviews of a PR, showing their progress.
+    If the cancelled event is set, the files that haven't started are dropped.
+    The reviews themselves aren't kept: they are read back from the journal when the
+    review is saved, see iter_combined_reviews.
+    
+    Returns:
+    - The number of files whose review failed, or None if the review was cancelled.
+    
+    Raises:
+    - ReviewError if the review can't go on at all. The files that haven't started are dropped.
+    """
+    failed = 0
+    segment_loader = tqdm(total=len(futures), position=0, leave=True, desc=colored(description, "white"), disable=not show_progress) 
+    try:
+        with metrics.phase("review"):
+            for future in as_completed(futures):
+                if cancelled is not None and cancelled.is_set():
+                    for pending in futures:
+                        pending.cancel()
+                    return None
+                if review_failed(future.result()):
+                    failed += 1
+                # Update the loader
+                segment_loader.update(1)
+    except (ReviewError, KeyboardInterrupt):
+        # Don't start any files that haven't been picked up yet, the finished ones are in the journal
+        for pending in futures:
+            pending.cancel()
+        raise
+    finally:
+        segment_loader.close()
+    return failed
+
+def review_code_with_chatgpt(diff, chatgpt_api_key, prompt_to_use, args, journal, stream_output=None):
+    """
+    Get a code review from ChatGPT using the provided diff.
+    This version of the function segments the diff by files and reviews
+    up to args.concurrency files at the same time.
+    If stream_output is given, the completions are streamed and each file's
+    review is written to it, in order, as it arrives.
+    Each file's review is recorded in the journal as it finishes, and only there: read the
+    review back in the original file order with journal.iter_reviews(), and format it with
+    iter_formatted_review (which replaces format_review, that joined every review in memory).
+    
+    Returns:
+    - The number of files whose review failed, see collect_review.
+    """
+    concurrency = max(1, getattr(args, 'concurrency', 1))
+    http_client.set_pool_size(concurrency)
+    review_cache = None if getattr(args, 'no_cache', False) else ReviewCache(REVIEW_CACHE_FILE, REVIEW_CACHE_MAX_BYTES)
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            stream_writer = OrderedStreamWriter(stream_output) if stream_output is not None else None
+            futures = submit_review(diff, chatgpt_api_key, prompt_to_use, args, executor, review_cache, stream_writer, journal)
+            # The progress bar would interleave with a review streamed to the terminal
+            return collect_review(futures, show_progress=stream_output is None or stream_output is not sys.stdout)
+    finally:
+        close_review_cache(review_cache)
+
+def review_code_with_prompts(diff, chatgpt_api_key, prompts_to_use, args, journals):
+    """
+    Review a diff with several prompts at once (see -type), sharing one executor, rate limiter and review cache.
+    Each prompt's file reviews are recorded in its journal, see iter_combined_reviews.
+    
+    Returns:
+    - The number of file reviews that failed, across every prompt.
+    """
+    concurrency = max(1, getattr(args, 'concurrency', 1))
+    http_client.set_pool_size(concurrency)
+    review_cache = None if getattr(args, 'no_cache', False) else ReviewCache(REVIEW_CACHE_FILE, REVIEW_CACHE_MAX_BYTES)
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            all_futures = submit_reviews(diff, chatgpt_api_key, prompts_to_use, args, executor, review_cache, None, journals)
+            return collect_review([future for futures in all_futures for future in futures])
+    finally:
+        close_review_cache(review_cache)
+
+def close_review_cache(review_cache):
+    """Print the cache hit/miss stats and close the cache."""
+    if review_cache is not None:
+        print(colored(f"\n{review_cache.stats()}", "cyan"))
+        review_cache.close()
+
+def read_streamed_completion(response, on_delta):
+    """
+    Read a streamed (server-sent events) chat completion, passing each piece of content to on_delta.
+    The request's total time, from sending it to the end of the body, is recorded as request_seconds.
+    
+    Returns:
+    - A response shaped like a non-streamed completion, so it can be passed to get_full_review.
+    """
+    content = []
+    usage = None
+    started = time.perf_counter()
+    with response:
+        response.encoding = 'utf-8'
+        # split_lines rather than iter_lines, which also splits on line separators inside the JSON strings
+        for line in split_lines(response.iter_content(chunk_size=None, decode_unicode=True)):
+            if not line or not line.startswith('data:'):
+                continue
+            payload = line[len('data:'):].strip()
+            if payload == '[DONE]':
+                break
+            chunk = json.loads(payload)
+            if chunk.get('usage'):
+                usage = chunk['usage']
+            choices = chunk.get('choices') or [{}]
+            delta = choices[0].get('delta', {}).get('content')
+            if delta:
+                content.append(delta)
+                on_delta(delta)
+    # elapsed is the time until the headers arrived
+    metrics.observe("request_seconds", response.elapsed.total_seconds() + time.perf_counter() - started)
+    return {"choices": [{"message": {"content": "".join(content)}}], "usage": usage}
 
 def get_full_review(responses):
     full_review = ""
@@ -349,6 +1341,202 @@ def display_pr_menu(prs):
     else:
         return None
 
+def parse_pr_targets(args, default_owner, default_repo):
+    """Build the list of (owner, repo, pr_number) to review in batch mode.
+    
+    PRs come from -prs and -all-open (for -repo, or the configured repo) and from -pr-file,
+    which has one 'owner/repo#number' per line, or 'owner/repo' for all of its open PRs.
+    """
+    owner, repo = args.repo.split('/', 1) if args.repo else (default_owner, default_repo)
+    targets = []
+    if args.prs:
+        targets += [(owner, repo, int(number)) for number in args.prs.split(',') if number.strip()]
+    if args.all_open:
+        targets += [(owner, repo, pr['number']) for pr in get_all_open_pull_requests(owner, repo)]
+    if args.pr_file:
+        with open(args.pr_file, "r") as file:
+            for line in file:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                match = re.match(r'^([^/\s]+)/([^#\s]+)(?:#(\d+))?$', line)
+                if not match:
+                    print(colored(f"Skipping invalid line in {args.pr_file}: {line}", "yellow"))
+                elif match.group(3):
+                    targets.append((match.group(1), match.group(2), int(match.group(3))))
+                else:
+                    targets += [(match.group(1), match.group(2), pr['number'])
+                                for pr in get_all_open_pull_requests(match.group(1), match.group(2))]
+    # Drop duplicates but keep the order
+    return list(dict.fromkeys(targets))
+
+def get_output_extension(format_type):
+    return {'plain': 'txt', 'json': 'json', 'html': 'html'}[format_type]
+
+def open_output(output_file):
+    """Open a file in the OUTPUT_DIR directory for writing."""
+    # Check if 'out' directory exists, if not, create it
+    if not os.path.exists(OUTPUT_DIR):
+        os.makedirs(OUTPUT_DIR)
+
+    # Ensure the output is saved in the 'out' subdirectory
+    return open(os.path.join(OUTPUT_DIR, output_file), 'w')
+
+def save_review(output_file, formatted_review):
+    """Save a formatted review, given as text or as an iterable of pieces, in the OUTPUT_DIR directory."""
+    with open_output(output_file) as file:
+        if isinstance(formatted_review, str):
+            file.write(formatted_review)
+        else:
+            file.writelines(formatted_review)
+        return file.name
+
+def run_batch(targets, chatgpt_api_key, args):
+    """
+    Review several pull requests without prompting, writing one review per PR to OUTPUT_DIR.
+    
+    Each PR is fetched and planned in turn and its files are queued on a single executor,
+    so files from the next PRs are reviewed while earlier ones finish. Every PR shares the
+    same tokenizer, HTTP sessions, rate limiter and review cache.
+    With -stream and the plain format, each review is written to its file as it arrives.
+    """
+    prompts_to_use = [prompts[review_type] for review_type in args.review_types]
+    concurrency = max(1, args.concurrency)
+    http_client.set_pool_size(concurrency)
+    review_cache = None if args.no_cache else ReviewCache(REVIEW_CACHE_FILE, REVIEW_CACHE_MAX_BYTES)
+    queued = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for owner, repo, pr_number in targets:
+            pr = get_pull_request(owner, repo, pr_number)
+            if 'head' not in pr:
+                print(colored(f"Could not fetch {owner}/{repo}#{pr_number}: {pr.get('message', 'Unknown error')}", "red"))
+                continue
+            try:
+                diff = get_diff_to_review(owner, repo, pr, args.review_type, args.incremental, args.budget)
+            except ReviewError as e:
+                print(colored(str(e), "red"))
+                continue
+            if diff is None:
+                print(colored(f"{owner}/{repo}#{pr_number} has no new commits since it was last reviewed.", "yellow"))
+                continue
+            if args.dry_run:
+                print(f"\n{owner}/{repo}#{pr_number} - {pr['title']}\n" + format_dry_run(diff, args))
+                continue
+            output_file = f"{owner}-{repo}-{pr_number}.{get_output_extension(args.format)}"
+            stream_output = open_output(output_file) if args.stream and args.format == 'plain' else None
+            stream_writer = OrderedStreamWriter(stream_output) if stream_output is not None else None
+            journals = [open_journal(owner, repo, pr, prompt_to_use, args.resume) for prompt_to_use in prompts_to_use]
+            all_futures = submit_reviews(diff, chatgpt_api_key, prompts_to_use, args, executor, review_cache,
+                                         [stream_writer] * len(prompts_to_use), journals)
+            queued.append((owner, repo, pr, all_futures, output_file, stream_output, journals))
+
+        while queued:
+            # Popped so each PR's futures, and the reviews they hold, are dropped once it is saved
+            owner, repo, pr, all_futures, output_file, stream_output, journals = queued.pop(0)
+            try:
+                failed = collect_review([future for futures in all_futures for future in futures], f"{owner}/{repo}#{pr['number']}")
+            except ReviewError as e:
+                print(colored(f"{owner}/{repo}#{pr['number']}: {FAILED_REVIEW_MESSAGE}: {e}", "red"))
+                if stream_output is not None:
+                    stream_output.write(f"\n\n{FAILED_REVIEW_MESSAGE}: {e}\n")
+                    stream_output.close()
+                close_journals(journals)
+                continue
+            if stream_output is not None:
+                stream_output.close()
+            else:
+                # Rendered from the journals one file at a time
+                save_review(output_file, iter_formatted_review(iter_combined_reviews(args.review_types, journals), args.format))
+            close_journals(journals)
+            if failed:
+                print(colored(f"{owner}/{repo}#{pr['number']}: some files failed, run again with -resume to retry them. "
+                              f"Saved {os.path.join(OUTPUT_DIR, output_file)}", "red"))
+                continue
+            save_reviewed_sha(owner, repo, pr['number'], args.review_type, pr['head']['sha'])
+            print(colored(f"Saved {os.path.join(OUTPUT_DIR, output_file)}", "green"))
+    close_review_cache(review_cache)
+
+def post_review_comment(owner, repo, pr_number, body):
+    """Post a review as a comment on a pull request."""
+    url = f"{GITHUB_API_URL}/repos/{owner}/{repo}/issues/{pr_number}/comments"
+    response = github_client.post(url, json={"body": body})
+    if response.status_code != 201:
+        print(colored(f"Could not comment on {owner}/{repo}#{pr_number}: {response.status_code}", "red"))
+        return False
+    return True
+
+def review_pull_request_job(job, chatgpt_api_key, args, executor, review_cache):
+    """Review the pull request of a webhook job and post the review as a comment."""
+    pr = get_pull_request(job.owner, job.repo, job.pr_number)
+    if 'head' not in pr:
+        print(colored(f"Could not fetch {job}: {pr.get('message', 'Unknown error')}", "red"))
+        return
+    if pr['head']['sha'] != job.head_sha:
+        print(colored(f"Skipping {job}, the PR has moved on to {pr['head']['sha'][:7]}", "yellow"))
+        return
+    try:
+        diff = get_diff_to_review(job.owner, job.repo, pr, args.review_type, args.incremental, args.budget)
+    except ReviewError as e:
+        # Nothing is posted or recorded, so the next push or a retry reviews the PR
+        print(colored(f"{job}: {e}", "red"))
+        return
+    if diff is None or job.cancelled.is_set():
+        return
+    prompts_to_use = [prompts[review_type] for review_type in args.review_types]
+    # Always resume, so a restarted server doesn't pay for the files it already reviewed
+    journals = [open_journal(job.owner, job.repo, pr, prompt_to_use, True) for prompt_to_use in prompts_to_use]
+    try:
+        all_futures = submit_reviews(diff, chatgpt_api_key, prompts_to_use, args, executor, review_cache, None, journals)
+        failed = collect_review([future for futures in all_futures for future in futures], str(job), show_progress=False,
+                                cancelled=job.cancelled)
+        if failed is None or job.cancelled.is_set():
+            print(colored(f"Cancelled {job}, a newer commit was pushed", "yellow"))
+            return
+        if failed:
+            print(colored(f"{job}: {failed} file reviews failed, not commenting", "red"))
+            return
+        # A comment is a single string, so this is the one place the whole review is put together
+        review = "\n\n".join(iter_combined_reviews(args.review_types, journals))
+    finally:
+        close_journals(journals)
+    body = f"## YACRB {', '.join(args.review_types)} review\n\n{review}\n\n<!-- yacrb:sha={job.head_sha} -->"
+    if post_review_comment(job.owner, job.repo, job.pr_number, body):
+        save_reviewed_sha(job.owner, job.repo, job.pr_number, args.review_type, job.head_sha)
+        print(colored(f"Reviewed {job}", "green"))
+
+def run_server(chatgpt_api_key, args, secret=None, repos=None):
+    """
+    Run a webhook server that reviews pull requests as GitHub reports new pushes.
+    
+    The tokenizer, HTTP sessions, rate limiter, review cache and file executor stay warm
+    between jobs. A push to a PR that is already queued or being reviewed supersedes it.
+
+    Parameters:
+    - secret: The WEBHOOK_SECRET deliveries are signed with. Without it the server only listens on SERVE_LOCAL_HOST.
+    - repos: The "owner/repo" names to review, deliveries for any other repository are refused.
+    """
+    host = ""
+    if not secret:
+        host = SERVE_LOCAL_HOST
+        print(colored(f"WEBHOOK_SECRET is not set, so deliveries can't be verified: only listening on {host}", "yellow"))
+    concurrency = max(1, args.concurrency)
+    http_client.set_pool_size(concurrency)
+    review_cache = None if args.no_cache else ReviewCache(REVIEW_CACHE_FILE, REVIEW_CACHE_MAX_BYTES)
+    # Load the tokenizer now rather than on the first webhook
+    get_tokenizer(args.model if args.model is not None else model)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        job_queue = ReviewJobQueue(
+            lambda job: review_pull_request_job(job, chatgpt_api_key, args, executor, review_cache), SERVE_WORKERS)
+        server = ReviewServer((host, args.port), job_queue, secret, repos)
+        server.get_routes["/metrics"] = lambda: ("text/plain; version=0.0.4", metrics.to_prometheus())
+        print(colored(f"Listening for GitHub pull_request webhooks for {', '.join(repos)} on port {args.port}", "green"))
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            job_queue.stop()
+    close_review_cache(review_cache)
+
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Generate code reviews using ChatGPT.')
     parser.add_argument('-format', dest='format', choices=['plain', 'json', 'html'], default='plain',
@@ -357,36 +1545,109 @@ def parse_arguments():
                         help='Filename to save the code review. If not provided, the review is printed to the console.')
     # Read the keys from the prompts object
     keys_list = list(prompts.keys())
-    parser.add_argument('-type', dest='review_type', choices=keys_list, default="general",
-                        help=f'The type of code review to do. These will change if it reviews for security, performance etc.')
-    parser.add_argument('-model', dest='model', choices=['gpt-4', 'gpt-3.5-turbo', 'gpt-3.5-turbo-16k'], default=None,
-                        help='Change the model for this review')
-    return parser.parse_args()
+    parser.add_argument('-type', dest='review_type', default="general",
+                        help=f'The type of code review to do: {", ".join(keys_list)}. Several comma separated types, or all, '
+                             'review the diff once for each of them and combine the reviews by file.')
+    parser.add_argument('-model', dest='model', default=None,
+                        help='Change the model for this review, e.g. gpt-4, gpt-3.5-turbo or gpt-3.5-turbo-16k. '
+                             'Every file is reviewed with it on the default backend, ignoring the ROUTING rules.')
+    parser.add_argument('-concurrency', dest='concurrency', type=int, default=1,
+                        help='Number of files to review in parallel. Requests still share the same rate limits.')
+    parser.add_argument('-incremental', dest='incremental', action='store_true',
+                        help='Only review the commits pushed since this PR was last reviewed.')
+    parser.add_argument('-budget', dest='budget', type=int, default=MAX_DIFF_TOKEN_SIZE,
+                        help='Token budget for the review. Past it, lockfiles and generated files are skipped first.')
+    parser.add_argument('-dry-run', dest='dry_run', action='store_true',
+                        help='Print the review plan (files, requests, cost and time) without calling the OpenAI API.')
+    parser.add_argument('-prs', dest='prs', default=None,
+                        help='Batch mode: comma separated PR numbers to review without prompting, e.g. 12,15,20.')
+    parser.add_argument('-all-open', dest='all_open', action='store_true',
+                        help='Batch mode: review every open PR of the repository.')
+    parser.add_argument('-pr-file', dest='pr_file', default=None,
+                        help='Batch mode: a file with one owner/repo#number (or owner/repo for all open PRs) per line.')
+    parser.add_argument('-repo', dest='repo', default=None,
+                        help='Batch mode: the owner/repo used by -prs and -all-open. Defaults to the configured repo.')
+    parser.add_argument('-stream', dest='stream', action='store_true',
+                        help='Stream the review as it is written. Plain reviews stream into the -output file, others to the console.')
+    parser.add_argument('-serve', dest='serve', action='store_true',
+                        help='Run a webhook server that reviews PRs when GitHub sends pull_request events, and comments the review.')
+    parser.add_argument('-port', dest='port', type=int, default=SERVE_PORT,
+                        help='The port the -serve webhook server listens on.')
+    parser.add_argument('-metrics', dest='metrics_file', default=None,
+                        help='Save timings, request latencies, token usage, retries and rate limit waits to this JSON file.')
+    parser.add_argument('-resume', dest='resume', action='store_true',
+                        help='Reuse the file reviews journaled by an earlier run of the same PR, head commit and prompt, '
+                             'e.g. one that was interrupted or had files fail.')
+    parser.add_argument('-no-compact', dest='no_compact', action='store_true',
+                        help='Send the diff as it is, without trimming context, summarizing whitespace-only and '
+                             'deleted hunks, stripping git headers or applying SKIP_PATHS.')
+    parser.add_argument('-no-dedup', dest='no_dedup', action='store_true',
+                        help='Review every file on its own, even when it repeats the changes of another file.')
+    parser.add_argument('-no-pack', dest='no_pack', action='store_true',
+                        help='Send every file in its own request instead of grouping small files into shared requests.')
+    parser.add_argument('-no-cache', dest='no_cache', action='store_true',
+                        help='Ignore the review cache and review every file again.')
+    parser.add_argument('-warm-cache', dest='warm_cache', default=None, metavar='DIR',
+                        help='Download the tokenizer files for every model into DIR and exit. Set TOKENIZER_CACHE_DIR to DIR to load them offline.')
+    args = parser.parse_args()
+    try:
+        args.review_types = parse_review_types(args.review_type, keys_list)
+    except ValueError as e:
+        parser.error(str(e))
+    # Names the combination of types in review_state.json and the serve comments
+    args.review_type = ",".join(args.review_types)
+    return args
 
-def format_review(review, format_type):
+def parse_review_types(value, keys_list):
+    """Parse -type: a prompt name, several comma separated names, or all of them with 'all'."""
+    if value.strip() == "all":
+        return list(keys_list)
+    review_types = []
+    for review_type in value.split(","):
+        review_type = review_type.strip()
+        if review_type not in keys_list:
+            raise ValueError(f"Unknown review type {review_type!r}, choose from {', '.join(keys_list)} or all")
+        if review_type not in review_types:
+            review_types.append(review_type)
+    return review_types
+
+def iter_formatted_review(reviews, format_type):
+    """
+    Format file reviews one at a time, so a long review can be written out without holding all of it in memory.
+    
+    Returns:
+    - A generator of pieces of the formatted review.
+    """
+    separator = ""
     if format_type == 'plain':
-        return review
+        for review in reviews:
+            yield separator + review
+            separator = "\n\n"
     elif format_type == 'json':
-        return json.dumps({"review": review})
+        yield '{"review": "'
+        for review in reviews:
+            # The string escaping of each piece, without its quotes
+            yield json.dumps(separator + review)[1:-1]
+            separator = "\n\n"
+        yield '"}'
     elif format_type == 'html':
         with open("review_template.html", 'r') as template_file:
             html_template = template_file.read()
         
-        # Split the review content by file sections
-        file_sections = re.split(r'File: ', review)[1:]
-        
-        file_html_sections = []
-        for section in file_sections:
-            file_name, content = section.split('\n', 1)
-            file_html = f'<h2>File: {file_name}</h2><p>{content}</p>'
-            file_html_sections.append(file_html)
-        
-        # Replace the placeholder in the template with the populated file sections
-        populated_html = html_template.replace('<!-- The following section will be repeated for each file in the review -->', '\n'.join(file_html_sections))
-        
-        return populated_html
+        # Each file section replaces the placeholder in the template
+        placeholder = '<!-- The following section will be repeated for each file in the review -->'
+        before, _, after = html_template.partition(placeholder)
+        yield before
+        for review in reviews:
+            # Split the review content by file sections
+            for section in re.split(r'File: ', review)[1:]:
+                file_name, content = section.split('\n', 1) if '\n' in section else (section, '')
+                yield separator + f'<h2>File: {file_name}</h2><p>{content}</p>'
+                separator = "\n"
+        yield after
  
 if __name__ == "__main__":
+    journals = []
     try:
         # Load the configuration data
         config = load_config()
@@ -408,6 +1669,37 @@ if __name__ == "__main__":
             print(colored("An unexpected error occurred. Please ensure you have the config.json (OR ENV variables) and that they contain, keys, repo information, and model. Not found: ",'red'), e)
             exit()
         args = parse_arguments()
+        if args.stream and len(args.review_types) > 1:
+            print(colored("-stream reviews one type at a time, the combined review is written once every type is done.", "yellow"))
+            args.stream = False
+        if args.metrics_file:
+            # Written however the run ends
+            atexit.register(metrics.write_json, args.metrics_file)
+        if args.warm_cache:
+            warm_tokenizer_cache(args.warm_cache)
+            exit()
+        set_tokenizer_cache_dir(config.get('TOKENIZER_CACHE_DIR') or os.environ.get('TOKENIZER_CACHE_DIR'))
+        GITHUB_API_URL = config.get('GITHUB_API_URL') or os.environ.get('GITHUB_API_URL') or GITHUB_API_URL
+        configure_github_client(github_api_key)
+        try:
+            configure_compaction(config, not args.no_compact)
+            configure_dedup(config, not args.no_dedup)
+            configure_backends(config)
+        except (ValueError, TypeError, AttributeError) as e:
+            print(colored("Invalid compaction, deduplication, BACKENDS or ROUTING settings in config.json: ", 'red'), e)
+            exit()
+
+        if args.serve:
+            webhook_repos = config.get('WEBHOOK_REPOS') or os.environ.get('WEBHOOK_REPOS') or f"{repo_owner}/{repo_name}"
+            if isinstance(webhook_repos, str):
+                webhook_repos = [name.strip() for name in webhook_repos.split(",") if name.strip()]
+            run_server(chatgpt_api_key, args, config.get('WEBHOOK_SECRET') or os.environ.get('WEBHOOK_SECRET'), webhook_repos)
+            exit()
+
+        if args.prs or args.all_open or args.pr_file:
+            run_batch(parse_pr_targets(args, repo_owner, repo_name), chatgpt_api_key, args)
+            exit()
+
         print("\n")
         print_asc_logo()
 
@@ -431,29 +1723,63 @@ if __name__ == "__main__":
         
         print(f"Reviewing PR #{pr_number} - {pr['title']}")
         
-        diff = get_pull_request_diff(repo_owner, repo_name, pr_number)
+        try:
+            diff = get_diff_to_review(repo_owner, repo_name, pr, args.review_type, args.incremental, args.budget)
+        except ReviewError as e:
+            print(colored(str(e), "red"))
+            exit()
+        if diff is None:
+            print(colored(f"\nPR #{pr_number} has no new commits since it was last reviewed.\n", "yellow"))
+            exit()
 
-        if args.review_type:
-            review = review_code_with_chatgpt(diff, chatgpt_api_key, prompts[args.review_type], args)
-        else: 
-            review = review_code_with_chatgpt(diff, chatgpt_api_key, prompt, args)
-        formatted_review = format_review(review, args.format)
-        
+        if args.dry_run:
+            print("\n" + format_dry_run(diff, args) + "\n")
+            exit()
 
-        if args.output_file:
-            # Check if 'out' directory exists, if not, create it
-            if not os.path.exists('out'):
-                os.makedirs('out')
+        # Plain reviews are streamed straight to where they are saved, anything else is streamed to the console
+        streamed_plain = args.stream and args.format == 'plain'
+        stream_output = None
+        if args.stream:
+            stream_output = open_output(args.output_file) if streamed_plain and args.output_file else sys.stdout
+            print("\n")
 
-            # Ensure the output is saved in the 'out' subdirectory
-            output_path = os.path.join('out', args.output_file)
-            with open(output_path, 'w') as file:
-                file.write(formatted_review)
-                print("\n")
+        prompts_to_use = [prompts[review_type] for review_type in args.review_types]
+        journals = [open_journal(repo_owner, repo_name, pr, prompt_to_use, args.resume) for prompt_to_use in prompts_to_use]
+        try:
+            if len(prompts_to_use) == 1:
+                failed = review_code_with_chatgpt(diff, chatgpt_api_key, prompts_to_use[0], args, journals[0], stream_output)
+            else:
+                failed = review_code_with_prompts(diff, chatgpt_api_key, prompts_to_use, args, journals)
+        except ReviewError as e:
+            print(colored(f"\n{FAILED_REVIEW_MESSAGE}: {e}\n", "red"))
+            if stream_output is not None and stream_output is not sys.stdout:
+                stream_output.write(f"\n\n{FAILED_REVIEW_MESSAGE}: {e}")
+                stream_output.close()
+            close_journals(journals)
+            exit()
+        if not failed:
+            save_reviewed_sha(repo_owner, repo_name, pr['number'], args.review_type, pr['head']['sha'])
+        if stream_output is not None and stream_output is not sys.stdout:
+            stream_output.close()
+
+        # Rendered from the journals one file at a time
+        reviews = iter_combined_reviews(args.review_types, journals)
+        if streamed_plain:
+            print("\n")
+        elif args.output_file:
+            save_review(args.output_file, iter_formatted_review(reviews, args.format))
+            print("\n")
         else:
             print("\n")
-            print(formatted_review)
+            for piece in iter_formatted_review(reviews, args.format):
+                sys.stdout.write(piece)
             print("\n")
+        if failed:
+            print(colored(f"{failed} file reviews failed, run again with -resume to retry only those files.", "red"))
+        close_journals(journals)
     except KeyboardInterrupt:
         print("\n" * 2)
+        if journals:
+            print(colored(f"Interrupted. The finished files are saved in {', '.join(journal.path for journal in journals)}, "
+                          "run again with -resume to pick up where this run stopped.", "yellow"))
 
@@ -0,0 +1,180 @@
+import re
+import copy
+import fnmatch
+
+# Unchanged lines kept around each change, the same as git's default
+DEFAULT_CONTEXT_LINES = 3
+# Paths that are never reviewed: lockfiles and vendored dependencies
+DEFAULT_SKIP_PATHS = (
+    "package-lock.json", "yarn.lock", "pnpm-lock.yaml", "poetry.lock", "Pipfile.lock", "Cargo.lock",
+    "Gemfile.lock", "composer.lock", "go.sum", "vendor/*", "node_modules/*"
+)
+# What to do with hunks that only change whitespace, or only delete lines
+HUNK_MODES = ("keep", "summarize", "drop")
+# Git header lines that repeat what the 'diff --git' line already says
+REDUNDANT_HEADER_PATTERN = re.compile(r'^(index |similarity index |dissimilarity index |--- |\+\+\+ )')
+HUNK_HEADER_PATTERN = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@(.*)$')
+
+def matches_path(path, pattern):
+    """Match a path against a glob rule.
+
+    A rule without a '/' matches the file name or any directory name in the path
+    ('yarn.lock', '*.pb.go', 'node_modules'). A rule with a '/' matches the whole path
+    or any trailing part of it ('vendor/*' matches 'vendor/a.go' and 'src/vendor/a.go').
+    """
+    if "/" not in pattern:
+        return any(fnmatch.fnmatch(part, pattern) for part in path.split("/"))
+    return fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(path, "*/" + pattern)
+
+def is_context(line):
+    return not line or line[0] == ' '
+
+def normalize_whitespace(line):
+    """Strip the trailing whitespace of a line.
+
+    Only trailing whitespace is ignored: indentation can change what the code means, and
+    whitespace inside a line may be part of a string literal.
+    """
+    return line.rstrip()
+
+class DiffCompactor:
+    """Shrinks file diffs before they are tokenized and sent for review.
+
+    - context_lines: unchanged lines kept around each change. Hunks are split where
+      more than twice as many unchanged lines separate two changes. None keeps every line.
+    - whitespace_hunks / deletion_hunks: 'keep', 'summarize' (replace the hunk's lines
+      with a one line note) or 'drop' hunks that only change whitespace / only delete lines.
+      Only trailing whitespace and blank lines count as whitespace-only changes, and deletions
+      are kept by default since a removed check is often what a review needs to see.
+    - strip_headers: remove the index, similarity and ---/+++ header lines.
+    - skip_paths: glob rules of files that are not reviewed at all, see matches_path.
+    """
+    def __init__(self, context_lines=DEFAULT_CONTEXT_LINES, whitespace_hunks="summarize", deletion_hunks="keep",
+                 strip_headers=True, skip_paths=DEFAULT_SKIP_PATHS):
+        for mode in (whitespace_hunks, deletion_hunks):
+            if mode not in HUNK_MODES:
+                raise ValueError(f"Unknown hunk mode {mode!r}, expected one of {', '.join(HUNK_MODES)}")
+        self.context_lines = context_lines
+        self.whitespace_hunks = whitespace_hunks
+        self.deletion_hunks = deletion_hunks
+        self.strip_headers = strip_headers
+        self.skip_paths = tuple(skip_paths)
+
+    @classmethod
+    def from_settings(cls, settings):
+        """Build a compactor from config.json / environment values, which may be strings.
+
+        Keys: COMPACT_CONTEXT_LINES, COMPACT_WHITESPACE_HUNKS, COMPACT_DELETION_HUNKS,
+        COMPACT_STRIP_HEADERS and SKIP_PATHS (a list, or a comma separated string).
+        """
+        context_lines = settings.get("COMPACT_CONTEXT_LINES")
+        if context_lines in (None, ""):
+            context_lines = DEFAULT_CONTEXT_LINES
+        elif int(context_lines) < 0:
+            context_lines = None
+        else:
+            context_lines = int(context_lines)
+        strip_headers = settings.get("COMPACT_STRIP_HEADERS", True)
+        if isinstance(strip_headers, str):
+            strip_headers = strip_headers.strip().lower() not in ("0", "false", "no", "off")
+        skip_paths = settings.get("SKIP_PATHS")
+        if skip_paths is None:
+            skip_paths = DEFAULT_SKIP_PATHS
+        elif isinstance(skip_paths, str):
+            skip_paths = [path.strip() for path in skip_paths.split(",") if path.strip()]
+        return cls(context_lines,
+                   settings.get("COMPACT_WHITESPACE_HUNKS") or "summarize",
+                   settings.get("COMPACT_DELETION_HUNKS") or "keep",
+                   strip_headers, skip_paths)
+
+    def should_skip(self, file_diff):
+        """Return True if the file matches one of the skip_paths rules."""
+        return bool(file_diff.filename) and any(matches_path(file_diff.filename, pattern) for pattern in self.skip_paths)
+
+    def compact(self, file_diff):
+        """Return a compacted copy of a FileDiff. The original is left unchanged."""
+        compacted = copy.copy(file_diff)
+        compacted.header = file_diff.header
+        if self.strip_headers:
+            compacted.header = file_diff.header[:1] + [line for line in file_diff.header[1:]
+                                                       if not REDUNDANT_HEADER_PATTERN.match(line)]
+        compacted.hunks = []
+        for hunk in file_diff.hunks:
+            for trimmed in self.trim_context(hunk):
+                summarized = self.summarize_hunk(trimmed)
+                if summarized is not None:
+                    compacted.hunks.append(summarized)
+        return compacted
+
+    def trim_context(self, hunk):
+        """Keep context_lines unchanged lines around each change, splitting the hunk on longer runs.
+
+        Returns:
+        - A list of hunks. The hunk itself is returned when there is nothing to trim.
+        """
+        match = HUNK_HEADER_PATTERN.match(hunk[0])
+        body = hunk[1:]
+        changes = [idx for idx, line in enumerate(body) if line[:1] in ('+', '-')]
+        if self.context_lines is None or match is None or not changes:
+            return [hunk]
+        keep = [False] * len(body)
+        for idx in changes:
+            for kept in range(max(0, idx - self.context_lines), min(len(body), idx + self.context_lines + 1)):
+                keep[kept] = True
+        if all(keep):
+            return [hunk]
+
+        hunks = []
+        old_line, new_line = int(match.group(1)), int(match.group(3))
+        section = match.group(5)
+        current = None
+        for idx, line in enumerate(body):
+            if keep[idx]:
+                if current is None:
+                    current = {"old_start": old_line, "new_start": new_line, "old_count": 0, "new_count": 0, "lines": []}
+                    hunks.append(current)
+                current["lines"].append(line)
+            else:
+                current = None
+            old_step = 1 if is_context(line) or line[0] == '-' else 0
+            new_step = 1 if is_context(line) or line[0] == '+' else 0
+            old_line += old_step
+            new_line += new_step
+            if current is not None:
+                current["old_count"] += old_step
+                current["new_count"] += new_step
+
+        result = []
+        for trimmed in hunks:
+            # Like git, an empty side of a hunk points at the line before it
+            old_start = trimmed["old_start"] if trimmed["old_count"] else trimmed["old_start"] - 1
+            new_start = trimmed["new_start"] if trimmed["new_count"] else trimmed["new_start"] - 1
+            header = f"@@ -{old_start},{trimmed['old_count']} +{new_start},{trimmed['new_count']} @@{section}"
+            result.append([header] + trimmed["lines"])
+        return result
+
+    def summarize_hunk(self, hunk):
+        """Apply whitespace_hunks and deletion_hunks to a hunk.
+
+        Returns:
+        - The hunk, its summary, or None if it is dropped.
+        """
+        added = [line[1:] for line in hunk[1:] if line.startswith('+')]
+        deleted = [line[1:] for line in hunk[1:] if line.startswith('-')]
+        if not added and not deleted:
+            return hunk
+        if ([normalize_whitespace(line) for line in added if line.strip()] ==
+                [normalize_whitespace(line) for line in deleted if line.strip()]):
+            mode = self.whitespace_hunks
+            changed = max(len(added), len(deleted))
+            note = f"[whitespace-only changes to {changed} line{'s' if changed != 1 else ''} omitted]"
+        elif not added:
+            mode = self.deletion_hunks
+            note = f"[{len(deleted)} deleted line{'s' if len(deleted) != 1 else ''} omitted]"
+        else:
+            return hunk
+        if mode == "keep":
+            return hunk
+        if mode == "drop":
+            return None
+        return [hunk[0], note]
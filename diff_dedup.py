@@ -0,0 +1,148 @@
+import re
+import copy
+import random
+import hashlib
+
+# Hunks with fewer changed lines than this are too generic ('+}') to be shared between files
+DEFAULT_MIN_HUNK_LINES = 2
+MINHASH_PERMUTATIONS = 64           # Size of the MinHash signatures used to find near-duplicate files
+MINHASH_BANDS = 16                  # Locality-sensitive hashing bands, each of MINHASH_PERMUTATIONS / MINHASH_BANDS rows
+SHINGLE_SIZE = 3                    # Words per shingle when comparing the changes of two files
+MERSENNE_PRIME = (1 << 61) - 1
+
+def changed_lines(hunk):
+    """The added and deleted lines of a hunk with their whitespace collapsed, ignoring blank lines."""
+    lines = []
+    for line in hunk[1:]:
+        if line[:1] in ('+', '-'):
+            content = " ".join(line[1:].split())
+            if content:
+                lines.append(line[0] + content)
+    return lines
+
+def hash_text(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class MinHash:
+    """MinHash signatures, whose share of equal values estimates the Jaccard similarity of two sets."""
+    def __init__(self, num_perm=MINHASH_PERMUTATIONS, seed=1):
+        rng = random.Random(seed)
+        self.params = [(rng.randrange(1, MERSENNE_PRIME), rng.randrange(0, MERSENNE_PRIME)) for _ in range(num_perm)]
+
+    def signature(self, shingles):
+        hashes = [int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+                  for shingle in shingles]
+        return tuple(min((a * value + b) % MERSENNE_PRIME for value in hashes) for a, b in self.params)
+
+    @staticmethod
+    def similarity(first, second):
+        return sum(1 for x, y in zip(first, second) if x == y) / len(first)
+
+def shingles_of(lines):
+    """Word shingles of the changed lines of a file."""
+    words = re.findall(r"\w+|[^\w\s]", "\n".join(lines))
+    if len(words) < SHINGLE_SIZE:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[idx:idx + SHINGLE_SIZE]) for idx in range(len(words) - SHINGLE_SIZE + 1)}
+
+class HunkDeduplicator:
+    """Finds changes repeated across the files of a diff, e.g. by a codemod, so they are reviewed once.
+
+    Hunks are compared on their changed lines, with whitespace normalised and line numbers
+    and context ignored. Hunks with fewer than min_hunk_lines changed lines are too generic to
+    compare this way, and a file with any of them is never treated as a duplicate.
+    - A file whose hunks are all the same as an earlier file's is a duplicate of it: it
+      isn't sent for review and gets the review of that earlier file (its representative).
+    - If similarity is set, a file whose changes are at least that similar (estimated with
+      MinHash) to an earlier file's is a near-duplicate of it, and is handled the same way.
+    - In the remaining files, a hunk that was already seen in an earlier file is replaced
+      with a note pointing at that file.
+    """
+    def __init__(self, similarity=None, min_hunk_lines=DEFAULT_MIN_HUNK_LINES):
+        if similarity is not None and not 0 < similarity <= 1:
+            raise ValueError(f"The duplicate similarity must be between 0 and 1, not {similarity}")
+        self.similarity = similarity
+        self.min_hunk_lines = min_hunk_lines
+        self.minhash = MinHash() if similarity is not None else None
+
+    @classmethod
+    def from_settings(cls, settings):
+        """Build a deduplicator from config.json / environment values (DEDUP_SIMILARITY, DEDUP_MIN_HUNK_LINES)."""
+        similarity = settings.get("DEDUP_SIMILARITY")
+        min_hunk_lines = settings.get("DEDUP_MIN_HUNK_LINES")
+        return cls(float(similarity) if similarity not in (None, "") else None,
+                   int(min_hunk_lines) if min_hunk_lines not in (None, "") else DEFAULT_MIN_HUNK_LINES)
+
+    def deduplicate(self, file_diffs):
+        """
+        Returns:
+        - A list with a dict per file, in order: 'file_diff' (a copy with repeated hunks replaced
+          by notes, or the file_diff itself), 'duplicate_of' (the index of the representative
+          file, or None), 'similarity' and 'shared_hunks' (the number of hunks replaced by notes).
+        """
+        results = []
+        signatures = {}         # Hunk keys of a whole file -> index of the first file with them
+        hunk_owners = {}        # Hunk key -> index of the first file with that hunk
+        bands = {}              # LSH band -> indexes of the files in it
+        minhashes = {}
+        for idx, file_diff in enumerate(file_diffs):
+            hunk_lines = [changed_lines(hunk) for hunk in file_diff.hunks]
+            keys = [hash_text("\n".join(lines)) if lines else None for lines in hunk_lines]
+            signature = tuple(key for key in keys if key is not None)
+            result = {"file_diff": file_diff, "duplicate_of": None, "similarity": None, "shared_hunks": 0}
+            results.append(result)
+            if not signature:
+                continue
+            # A file with a generic hunk ('+    return None') can't be told apart from an unrelated file
+            # making the same small edit somewhere else, so it is always reviewed
+            distinctive = all(len(lines) >= self.min_hunk_lines for lines in hunk_lines if lines)
+
+            if distinctive:
+                if signature in signatures:
+                    result["duplicate_of"], result["similarity"] = signatures[signature], 1.0
+                    continue
+                if self.minhash is not None:
+                    minhash = self.minhash.signature(shingles_of([line for lines in hunk_lines for line in lines]))
+                    match = self.find_similar(minhash, minhashes, bands)
+                    if match is not None:
+                        result["duplicate_of"], result["similarity"] = match
+                        continue
+                    self.add_to_bands(idx, minhash, minhashes, bands)
+                signatures[signature] = idx
+
+            hunks = []
+            for hunk, lines, key in zip(file_diff.hunks, hunk_lines, keys):
+                owner = hunk_owners.get(key) if key is not None and len(lines) >= self.min_hunk_lines else None
+                if owner is None:
+                    if key is not None:
+                        hunk_owners.setdefault(key, idx)
+                    hunks.append(hunk)
+                else:
+                    hunks.append([hunk[0], f"[same change as in {file_diffs[owner].filename}, reviewed there]"])
+                    result["shared_hunks"] += 1
+            if result["shared_hunks"]:
+                result["file_diff"] = copy.copy(file_diff)
+                result["file_diff"].hunks = hunks
+        return results
+
+    def find_similar(self, minhash, minhashes, bands):
+        """Return (index, similarity) of the most similar earlier file above the threshold, or None."""
+        candidates = set()
+        for band in self.bands_of(minhash):
+            candidates.update(bands.get(band, ()))
+        best = None
+        for candidate in sorted(candidates):
+            similarity = MinHash.similarity(minhash, minhashes[candidate])
+            if similarity >= self.similarity and (best is None or similarity > best[1]):
+                best = (candidate, similarity)
+        return best
+
+    def add_to_bands(self, idx, minhash, minhashes, bands):
+        minhashes[idx] = minhash
+        for band in self.bands_of(minhash):
+            bands.setdefault(band, []).append(idx)
+
+    @staticmethod
+    def bands_of(minhash):
+        rows = len(minhash) // MINHASH_BANDS
+        return [(band, minhash[band * rows:(band + 1) * rows]) for band in range(MINHASH_BANDS)]
@@ -0,0 +1,157 @@
+import re
+
+# Files that are never worth reviewing (minified or bundled build output)
+SKIPPED_FILE_PATTERN = re.compile(r'\.(min\.js|min\.css)|bundle')
+
+class FileDiff:
+    """The diff of a single file.
+
+    Attributes:
+    - filename: The path of the file after the change.
+    - old_filename: The path of the file before the change.
+    - status: One of 'added', 'deleted', 'renamed', 'binary' or 'modified'.
+    - header: The 'diff --git' line and the git header lines that follow it.
+    - hunks: A list of hunks, each a list of lines starting with the '@@' line.
+    - additions / deletions: The number of added and deleted lines.
+    - dropped_lines: The number of hunk lines that weren't kept, see parse_diff's max_chars.
+    """
+    # Saves a dict per file, which adds up on diffs of thousands of files
+    __slots__ = ('old_filename', 'filename', 'status', 'header', 'hunks', 'additions', 'deletions', 'dropped_lines')
+
+    def __init__(self, git_line):
+        self.old_filename, self.filename = parse_git_line(git_line)
+        self.status = 'modified'
+        self.header = [git_line]
+        self.hunks = []
+        self.additions = 0
+        self.deletions = 0
+        self.dropped_lines = 0
+
+    @property
+    def lines(self):
+        lines = list(self.header)
+        for hunk in self.hunks:
+            lines.extend(hunk)
+        return lines
+
+    @property
+    def text(self):
+        return "\n".join(self.lines)
+
+def split_lines(chunks):
+    """Split text arriving in chunks into lines, only on '\\n'.
+
+    str.splitlines() and iter_lines() also split on form feeds, \\x1c-\\x1e, \\x85 and the
+    Unicode line separators, which can appear inside a changed line and would cut it in two.
+    A trailing '\\r' is removed from each line.
+    """
+    pending = ""
+    for chunk in chunks:
+        lines = (pending + chunk).split("\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line[:-1] if line.endswith("\r") else line
+    if pending:
+        yield pending[:-1] if pending.endswith("\r") else pending
+
+def parse_git_line(git_line):
+    """Get the old and new file names from a 'diff --git a/old b/new' line."""
+    match = re.match(r'diff --git a/(.*) b/(.*)$', git_line)
+    if match:
+        return match.group(1), match.group(2)
+    return None, None
+
+def parse_diff(lines, max_chars=None):
+    """Parse a unified git diff in a single pass.
+
+    Parameters:
+    - lines: An iterable of diff lines without line endings, e.g. split_lines(response.iter_content()).
+    - max_chars: If set, hunk lines are only kept until this many characters of them have been
+      kept, so a huge diff takes bounded memory. Lockfiles and generated files (see
+      is_low_priority) have their own max_chars, so they can't crowd out the source files
+      that come after them. Later lines are only counted, in dropped_lines.
+
+    Returns:
+    - A generator of FileDiff records, one per file, yielded as soon as each file ends.
+    """
+    current = None
+    low_priority = False
+    kept_chars = {False: 0, True: 0}    # Characters of hunk lines kept for source / low priority files
+    for line in lines:
+        if line.startswith('diff --git '):
+            if current is not None:
+                yield current
+            current = FileDiff(line)
+            low_priority = is_low_priority(current)
+            continue
+        if current is None:
+            continue  # Ignore anything before the first file
+
+        is_hunk_line = line.startswith('@@') or current.hunks or current.dropped_lines
+        if is_hunk_line and max_chars is not None:
+            if kept_chars[low_priority] + len(line) > max_chars or current.dropped_lines:
+                # Once a line is dropped the rest of the file is too, so a file is only ever cut short at the end
+                if not current.hunks and not current.dropped_lines:
+                    # Nothing of the file will be reviewed, only its name is needed
+                    current.header = current.header[:1]
+                current.dropped_lines += 1
+                continue
+            kept_chars[low_priority] += len(line)
+        if line.startswith('@@'):
+            current.hunks.append([line])
+        elif current.hunks:
+            current.hunks[-1].append(line)
+            if line.startswith('+'):
+                current.additions += 1
+            elif line.startswith('-'):
+                current.deletions += 1
+        else:
+            current.header.append(line)
+            if line.startswith('new file mode'):
+                current.status = 'added'
+            elif line.startswith('deleted file mode'):
+                current.status = 'deleted'
+            elif line.startswith('rename from '):
+                current.status = 'renamed'
+                current.old_filename = line[len('rename from '):]
+            elif line.startswith('rename to '):
+                current.filename = line[len('rename to '):]
+                low_priority = is_low_priority(current)
+            elif line.startswith('Binary files') or line.startswith('GIT binary patch'):
+                current.status = 'binary'
+            elif line.startswith('+++ b/'):
+                current.filename = line[len('+++ b/'):]
+                low_priority = is_low_priority(current)
+
+    if current is not None:
+        yield current
+
+def should_review(file_diff):
+    """Filter rules: skip minified/bundled files, deleted files, binary files and pure renames."""
+    if file_diff.filename and SKIPPED_FILE_PATTERN.search(file_diff.filename):
+        return False
+    if file_diff.status in ('deleted', 'binary'):
+        return False
+    if file_diff.status == 'renamed' and not file_diff.hunks and not file_diff.dropped_lines:
+        return False
+    return True
+
+def filter_file_diffs(file_diffs):
+    """Lazily apply the filter rules to a stream of FileDiff records."""
+    return (file_diff for file_diff in file_diffs if should_review(file_diff))
+
+# Files that are reviewed last when a PR is over its token budget (lockfiles, generated and vendored code)
+LOW_PRIORITY_FILE_PATTERN = re.compile(
+    r'(^|/)(package-lock\.json|yarn\.lock|pnpm-lock\.yaml|poetry\.lock|Pipfile\.lock|Cargo\.lock|Gemfile\.lock|composer\.lock|go\.sum)$'
+    r'|(^|/)(vendor|node_modules|dist|build|generated|__generated__)/'
+    r'|\.(pb\.go|map|snap|lock)$|_pb2\.py$|\.generated\.'
+)
+
+def is_low_priority(file_diff):
+    """Return True for lockfiles, generated and vendored files."""
+    return bool(file_diff.filename and LOW_PRIORITY_FILE_PATTERN.search(file_diff.filename))
+
+def added_line_density(file_diff):
+    """The fraction of changed lines in the file that are additions."""
+    changed = file_diff.additions + file_diff.deletions
+    return file_diff.additions / changed if changed else 0.0
@@ -0,0 +1,239 @@
+import time
+import json
+import codecs
+import hashlib
+import threading
+from requests.structures import CaseInsensitiveDict
+from sqlite_lru import SQLiteLRUStore
+
+# Response headers kept with a cached response
+CACHED_HEADERS = ("Content-Type", "Link", "ETag", "Last-Modified")
+
+class GitHubCache:
+    """A persistent cache of GitHub API responses stored in SQLite, for conditional requests.
+
+    Responses are stored with their ETag and Last-Modified validators. When the cache grows
+    past max_bytes the least recently used responses are evicted. Responses larger than
+    max_response_bytes aren't cached.
+    """
+    def __init__(self, path, max_bytes=100 * 1024 * 1024, max_response_bytes=10 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_response_bytes = min(max_response_bytes, max_bytes)
+        self.store = SQLiteLRUStore(path, "responses", ("etag TEXT", "last_modified TEXT", "headers TEXT NOT NULL",
+                                                        "body BLOB NOT NULL"), max_bytes)
+
+    @staticmethod
+    def make_key(url, params=None, accept=None):
+        """Hash everything that selects a response into a cache key."""
+        payload = json.dumps([url, sorted((params or {}).items()), accept or ""], default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Return the cached response for key as a dict, or None if it isn't cached."""
+        row = self.store.get(key)
+        if row is None:
+            return None
+        return {"etag": row[0], "last_modified": row[1], "headers": json.loads(row[2]), "body": row[3]}
+
+    def set(self, key, headers, body):
+        """Store a response and evict old responses if the cache is over its size limit."""
+        if len(body) > self.max_response_bytes:
+            return
+        kept = {name: headers[name] for name in CACHED_HEADERS if name in headers}
+        self.store.set(key, (headers.get("ETag"), headers.get("Last-Modified"), json.dumps(kept), body), len(body))
+
+    def close(self):
+        self.store.close()
+
+class CachedResponse:
+    """A cached response, served when GitHub answers a conditional request with 304 Not Modified.
+
+    It has the parts of requests.Response the GitHub functions use.
+    """
+    from_cache = True
+
+    def __init__(self, entry):
+        self.status_code = 200
+        self.headers = CaseInsensitiveDict(entry["headers"])
+        self.content = bytes(entry["body"])
+        self.encoding = "utf-8"
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or "utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.text)
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        # Incremental, so a character split between two chunks is decoded whole
+        decoder = codecs.getincrementaldecoder(self.encoding or "utf-8")(errors="replace")
+        for start in range(0, len(self.content), chunk_size):
+            chunk = self.content[start:start + chunk_size]
+            yield decoder.decode(chunk, final=start + chunk_size >= len(self.content)) if decode_unicode else chunk
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class RecordingResponse:
+    """Wraps a streamed response and stores its body once it has been read to the end.
+
+    Recording stops once the body passes max_bytes, so a large diff isn't held in memory
+    just to be turned away by the cache.
+    """
+    def __init__(self, response, on_complete, max_bytes):
+        self.response = response
+        self.on_complete = on_complete
+        self.max_bytes = max_bytes
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    @property
+    def encoding(self):
+        return self.response.encoding
+
+    @encoding.setter
+    def encoding(self, value):
+        self.response.encoding = value
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        chunks = []
+        size = 0
+        for chunk in self.response.iter_content(chunk_size=chunk_size, decode_unicode=decode_unicode):
+            if chunks is not None:
+                chunks.append(chunk if isinstance(chunk, bytes) else chunk.encode(self.encoding or "utf-8"))
+                size += len(chunks[-1])
+                if size > self.max_bytes:
+                    chunks = None
+            yield chunk
+        # Only a complete body is worth caching
+        if chunks is not None:
+            self.on_complete(b"".join(chunks))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.response.close()
+
+class GitHubClient:
+    """Sends GitHub API requests with conditional-request caching and rate limit awareness.
+
+    GET responses with an ETag or Last-Modified header are cached, and later requests for
+    them send If-None-Match / If-Modified-Since. GitHub answers 304 Not Modified, which
+    doesn't count against the rate limit, and the cached response is used.
+
+    The X-RateLimit-Remaining and X-RateLimit-Reset headers of every response are tracked.
+    Once fewer than reserve requests are left, requests wait for the limit to reset, and
+    rate limited responses (403/429) are retried after Retry-After or the reset time.
+    """
+    def __init__(self, http_client, cache=None, reserve=20, max_retries=3, max_wait=3600, metrics=None):
+        self.http_client = http_client
+        self.cache = cache              # A GitHubCache, or None to send every request unconditionally
+        self.reserve = reserve
+        self.max_retries = max_retries
+        self.max_wait = max_wait        # Longest wait in seconds for the rate limit to reset
+        self.metrics = metrics
+        self.remaining = None
+        self.reset_at = None            # Epoch seconds when the rate limit resets
+        self.lock = threading.Lock()
+
+    def update_rate_limit(self, headers):
+        """Track the rate limit reported by a response."""
+        try:
+            remaining = int(headers["X-RateLimit-Remaining"])
+            reset_at = float(headers["X-RateLimit-Reset"])
+        except (KeyError, TypeError, ValueError):
+            return
+        with self.lock:
+            self.remaining = remaining
+            self.reset_at = reset_at
+
+    def throttle(self):
+        """Wait for the rate limit to reset if we are down to the reserve."""
+        with self.lock:
+            if self.remaining is None or self.remaining > self.reserve or self.reset_at is None:
+                return
+            wait = self.reset_at - time.time()
+            if wait <= 0:
+                self.remaining = None
+                return
+        self.sleep(wait, f"GitHub rate limit nearly used up ({self.remaining} left), waiting {min(wait, self.max_wait):.0f}s")
+
+    def sleep(self, seconds, message):
+        seconds = min(seconds, self.max_wait)
+        print(message)
+        if self.metrics is not None:
+            self.metrics.increment("github_rate_limit_sleep_seconds", seconds)
+        time.sleep(seconds)
+
+    def retry_delay(self, response):
+        """Return how long to wait before retrying a rate limited response, or None if it wasn't rate limited."""
+        if response.status_code not in (403, 429):
+            return None
+        retry_after = response.headers.get("Retry-After")
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        if response.headers.get("X-RateLimit-Remaining") == "0" and response.headers.get("X-RateLimit-Reset"):
+            return max(0.0, float(response.headers["X-RateLimit-Reset"]) - time.time()) + 1
+        return None
+
+    def request(self, method, url, params=None, headers=None, stream=False, **kwargs):
+        headers = dict(headers or {})
+        key = None
+        if method == "GET" and self.cache is not None:
+            key = self.cache.make_key(url, params, headers.get("Accept"))
+        entry = None
+        for attempt in range(self.max_retries + 1):
+            self.throttle()
+            request_headers = dict(headers)
+            entry = self.cache.get(key) if key is not None else None
+            if entry is not None:
+                if entry["etag"]:
+                    request_headers["If-None-Match"] = entry["etag"]
+                if entry["last_modified"]:
+                    request_headers["If-Modified-Since"] = entry["last_modified"]
+            response = self.http_client.request(method, url, params=params, headers=request_headers, stream=stream,
+                                                **kwargs)
+            self.update_rate_limit(response.headers)
+            delay = self.retry_delay(response)
+            if delay is None or attempt == self.max_retries:
+                break
+            response.close()
+            self.sleep(delay, f"GitHub rate limited {url}, retrying in {min(delay, self.max_wait):.0f}s")
+
+        if self.metrics is not None:
+            self.metrics.increment("github_requests")
+        if response.status_code == 304 and entry is not None:
+            response.close()
+            if self.metrics is not None:
+                self.metrics.increment("github_not_modified")
+            return CachedResponse(entry)
+        if key is not None and response.status_code == 200 and (
+                response.headers.get("ETag") or response.headers.get("Last-Modified")):
+            response_headers = response.headers
+            store = lambda body: self.cache.set(key, response_headers, body)
+            if stream:
+                content_length = response.headers.get("Content-Length")
+                if content_length is not None and content_length.isdigit() and int(content_length) > self.cache.max_response_bytes:
+                    return response
+                return RecordingResponse(response, store, self.cache.max_response_bytes)
+            store(response.content)
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
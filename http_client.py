@@ -0,0 +1,69 @@
+import threading
+import requests
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+
+class HttpClient:
+    """Keep-alive HTTP sessions shared by every request, one per host.
+
+    Reusing a session keeps its TCP/TLS connections open between requests, so reviewing
+    many files or PRs only pays for the handshake once per pooled connection.
+    """
+    def __init__(self, pool_size=10, timeout=(10, 120)):
+        self.pool_size = pool_size
+        self.timeout = timeout          # (connect, read) seconds
+        self.sessions = {}
+        self.default_headers = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def host_of(url):
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def set_default_headers(self, url, headers):
+        """Set headers (e.g. authorization) sent with every request to the host of url."""
+        host = self.host_of(url)
+        with self.lock:
+            self.default_headers[host] = dict(headers)
+            if host in self.sessions:
+                self.sessions[host].headers.update(headers)
+
+    def set_pool_size(self, pool_size):
+        """Resize the connection pools, e.g. to match the review concurrency."""
+        with self.lock:
+            if pool_size <= self.pool_size:
+                return
+            self.pool_size = pool_size
+            for host, session in self.sessions.items():
+                session.mount(host, self.make_adapter())
+
+    def make_adapter(self):
+        return HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+
+    def session_for(self, url):
+        host = self.host_of(url)
+        with self.lock:
+            session = self.sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                session.mount(host, self.make_adapter())
+                session.headers.update(self.default_headers.get(host, {}))
+                self.sessions[host] = session
+            return session
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session_for(url).request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
@@ -0,0 +1,78 @@
+from diff_compactor import matches_path
+
+# Name of the backend built from OPEN_AI_URL and CHATGPT_API_KEY
+DEFAULT_BACKEND = "openai"
+# Conditions a routing rule can use, see ModelRouter
+RULE_CONDITIONS = ("paths", "min_file_tokens", "max_file_tokens", "low_priority")
+
+class Backend:
+    """An OpenAI-compatible chat completions endpoint: OpenAI itself, Azure, a vLLM or llama.cpp server...
+
+    Every backend has its own rate limiter, so a slow or throttled backend doesn't hold up the others.
+    """
+    def __init__(self, name, url, api_key=None, rate_limiter=None):
+        self.name = name
+        self.url = url                      # The full chat completions URL
+        self.api_key = api_key
+        self.rate_limiter = rate_limiter
+
+    @property
+    def headers(self):
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        return headers
+
+    def complete(self, data, estimated_tokens=None, stream=False):
+        """Send a chat completion request through the backend's rate limiter."""
+        return self.rate_limiter.make_request(self.url, method="POST", headers=self.headers, data=data,
+                                              estimated_tokens=estimated_tokens, stream=stream)
+
+def get_completions_url(settings):
+    """Build the chat completions URL from a backend's 'url' or 'base_url' (e.g. http://localhost:8000/v1)."""
+    if settings.get("url"):
+        return settings["url"]
+    if not settings.get("base_url"):
+        raise ValueError("A backend needs a 'base_url' or 'url'")
+    return settings["base_url"].rstrip("/") + "/chat/completions"
+
+class ModelRouter:
+    """Picks the backend and model each file is reviewed with.
+
+    Rules are checked in order and the first one whose conditions all match wins.
+    A rule has a 'model', an optional 'backend' (the default backend if missing) and
+    any of these conditions:
+    - paths: glob rules matched against the file name, see diff_compactor.matches_path
+    - min_file_tokens / max_file_tokens: bounds on the size of the file's diff
+    - low_priority: true for lockfiles, generated and vendored code, false for the rest
+
+    Files that match no rule use the default model on the default backend.
+    """
+    def __init__(self, rules, default_model, default_backend=DEFAULT_BACKEND):
+        self.rules = list(rules)
+        self.default_model = default_model
+        self.default_backend = default_backend
+        for rule in self.rules:
+            if not rule.get("model"):
+                raise ValueError(f"Routing rule {rule} has no model")
+            unknown = set(rule) - set(RULE_CONDITIONS) - {"model", "backend"}
+            if unknown:
+                raise ValueError(f"Routing rule {rule} has unknown keys: {', '.join(sorted(unknown))}")
+
+    def matches(self, rule, filename, token_count, low_priority):
+        if "paths" in rule and not (filename and any(matches_path(filename, pattern) for pattern in rule["paths"])):
+            return False
+        if "min_file_tokens" in rule and token_count < rule["min_file_tokens"]:
+            return False
+        if "max_file_tokens" in rule and token_count > rule["max_file_tokens"]:
+            return False
+        if "low_priority" in rule and bool(rule["low_priority"]) != low_priority:
+            return False
+        return True
+
+    def route(self, filename, token_count, low_priority=False):
+        """Return the (backend name, model) to review a file with."""
+        for rule in self.rules:
+            if self.matches(rule, filename, token_count, low_priority):
+                return rule.get("backend", self.default_backend), rule["model"]
+        return self.default_backend, self.default_model
@@ -0,0 +1,118 @@
+import json
+import time
+import threading
+import contextlib
+
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[idx] += 1
+                break
+
+    def cumulative_counts(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield bound, total
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "mean": round(self.sum / self.count, 6) if self.count else 0,
+            "max": round(self.max, 6),
+            "buckets": {str(bound): count for bound, count in self.cumulative_counts()}
+        }
+
+class Metrics:
+    """Timings and counters for a run, shared by every thread.
+
+    - phases: wall time and number of runs of each phase (GitHub fetches, tokenizing, reviewing...)
+    - histograms: latency distributions, e.g. of each OpenAI request
+    - counters: requests, retries, 429s, token usage, seconds spent waiting for rate limits...
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.phases = {}
+        self.histograms = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, value):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(value)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time a block of code as a run of the named phase."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                seconds, count = self.phases.get(name, (0.0, 0))
+                self.phases[name] = (seconds + elapsed, count + 1)
+
+    def record_usage(self, usage):
+        """Add the token usage reported by the OpenAI API."""
+        if not usage:
+            return
+        self.increment("prompt_tokens", usage.get("prompt_tokens", 0))
+        self.increment("completion_tokens", usage.get("completion_tokens", 0))
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "uptime_seconds": round(time.time() - self.started, 3),
+                "phases": {name: {"seconds": round(seconds, 6), "count": count}
+                           for name, (seconds, count) in self.phases.items()},
+                "counters": {name: round(value, 6) for name, value in self.counters.items()},
+                "histograms": {name: histogram.to_dict() for name, histogram in self.histograms.items()}
+            }
+
+    def to_prometheus(self, prefix="yacrb"):
+        """Render the metrics in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            lines.append(f"# TYPE {prefix}_phase_seconds_total counter")
+            for name, (seconds, _) in sorted(self.phases.items()):
+                lines.append(f'{prefix}_phase_seconds_total{{phase="{name}"}} {seconds}')
+            lines.append(f"# TYPE {prefix}_phase_runs_total counter")
+            for name, (_, count) in sorted(self.phases.items()):
+                lines.append(f'{prefix}_phase_runs_total{{phase="{name}"}} {count}')
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"# TYPE {prefix}_{name}_total counter")
+                lines.append(f"{prefix}_{name}_total {value}")
+            for name, histogram in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {prefix}_{name} histogram")
+                for bound, count in histogram.cumulative_counts():
+                    lines.append(f'{prefix}_{name}_bucket{{le="{bound}"}} {count}')
+                lines.append(f'{prefix}_{name}_bucket{{le="+Inf"}} {histogram.count}')
+                lines.append(f"{prefix}_{name}_sum {histogram.sum}")
+                lines.append(f"{prefix}_{name}_count {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path):
+        with open(path, "w") as file:
+            json.dump(self.to_dict(), file, indent=2)
@@ -0,0 +1,228 @@
+import re
+import json
+import hashlib
+import time
+import random
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class MockServer(ThreadingHTTPServer):
+    """Base class for the local stand-ins, started on a free port in a background thread."""
+    daemon_threads = True
+
+    def __init__(self, handler, latency=0.0):
+        super().__init__(("127.0.0.1", 0), handler)
+        self.latency = latency          # Seconds added to every response
+        self.request_count = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def send(self, status, body, content_type="application/json", headers=None):
+        data = body.encode("utf-8") if isinstance(body, str) else body
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def begin(self):
+        with self.server.lock:
+            self.server.request_count += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+    def log_message(self, format, *args):
+        pass
+
+class MockGitHub(MockServer):
+    """Mimics the api.github.com endpoints the bot uses.
+
+    prs maps a pull request number to its diff text. Open PRs are listed with pagination
+    (Link headers) and review comments are kept in self.comments. GET responses have an
+    ETag and conditional requests for unchanged responses get a 304 (see self.not_modified).
+    """
+    def __init__(self, prs, latency=0.0):
+        super().__init__(MockGitHubHandler, latency)
+        self.prs = prs
+        self.comments = []
+        self.not_modified = 0
+
+class MockGitHubHandler(MockHandler):
+    def send(self, status, body, content_type="application/json", headers=None):
+        if self.command != "GET" or status != 200:
+            super().send(status, body, content_type, headers)
+            return
+        data = body.encode("utf-8") if isinstance(body, str) else body
+        etag = '"' + hashlib.sha256(data).hexdigest()[:16] + '"'
+        headers = dict(headers or {}, ETag=etag)
+        if self.headers.get("If-None-Match") == etag:
+            with self.server.lock:
+                self.server.not_modified += 1
+            self.send_response(304)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        super().send(status, data, content_type, headers)
+
+    def do_GET(self):
+        self.begin()
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        match = re.match(r"^/repos/([^/]+)/([^/]+)/pulls/(\d+)(\.diff)?$", parts.path)
+        if match:
+            number = int(match.group(3))
+            if number not in self.server.prs:
+                self.send(404, json.dumps({"message": "Not Found"}))
+            elif match.group(4) or "diff" in self.headers.get("Accept", ""):
+                self.send(200, self.server.prs[number], "text/plain; charset=utf-8")
+            else:
+                self.send(200, json.dumps(self.pull_request(number)))
+            return
+        match = re.match(r"^/repos/([^/]+)/([^/]+)/pulls$", parts.path)
+        if match:
+            per_page = int(query.get("per_page", ["30"])[0])
+            page = int(query.get("page", ["1"])[0])
+            numbers = sorted(self.server.prs)
+            items = [self.pull_request(number) for number in numbers[(page - 1) * per_page:page * per_page]]
+            headers = {}
+            if page * per_page < len(numbers):
+                headers["Link"] = f'<{self.server.url}{parts.path}?per_page={per_page}&page={page + 1}>; rel="next"'
+            self.send(200, json.dumps(items), headers=headers)
+            return
+        self.send(404, json.dumps({"message": "Not Found"}))
+
+    def do_POST(self):
+        self.begin()
+        body = self.read_body()
+        match = re.match(r"^/repos/([^/]+)/([^/]+)/issues/(\d+)/comments$", self.path)
+        if not match:
+            self.send(404, json.dumps({"message": "Not Found"}))
+            return
+        with self.server.lock:
+            self.server.comments.append((int(match.group(3)), json.loads(body)["body"]))
+        self.send(201, json.dumps({"id": len(self.server.comments)}))
+
+    def pull_request(self, number):
+        return {
+            "number": number,
+            "title": f"Synthetic PR {number}",
+            "user": {"login": "benchmark"},
+            "head": {"sha": f"{number:040x}"}
+        }
+
+class MockOpenAI(MockServer):
+    """Mimics /v1/chat/completions with rate limit headers and injected 429s.
+
+    - latency: seconds before each response starts
+    - throttle_rate: fraction of requests answered with a 429
+    - request_limit / token_limit: per-minute limits reported in the x-ratelimit-* headers
+    - stream_delay: seconds between streamed chunks
+    """
+    def __init__(self, latency=0.0, throttle_rate=0.0, request_limit=10000, token_limit=2000000,
+                 stream_delay=0.0, seed=0):
+        super().__init__(MockOpenAIHandler, latency)
+        self.throttle_rate = throttle_rate
+        self.request_limit = request_limit
+        self.token_limit = token_limit
+        self.stream_delay = stream_delay
+        self.random = random.Random(seed)
+        self.throttled = 0
+        self.window_start = time.monotonic()
+        self.window_requests = 0
+        self.window_tokens = 0
+
+    def use_budget(self, tokens):
+        """Count a request against the current one-minute window and return the rate limit headers."""
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_start >= 60:
+                self.window_start = now
+                self.window_requests = 0
+                self.window_tokens = 0
+            throttle = (self.random.random() < self.throttle_rate
+                        or self.window_requests >= self.request_limit
+                        or self.window_tokens + tokens > self.token_limit)
+            if throttle:
+                self.throttled += 1
+            else:
+                self.window_requests += 1
+                self.window_tokens += tokens
+            reset = max(0.0, 60 - (now - self.window_start))
+            headers = {
+                "x-ratelimit-limit-requests": str(self.request_limit),
+                "x-ratelimit-limit-tokens": str(self.token_limit),
+                "x-ratelimit-remaining-requests": str(max(0, self.request_limit - self.window_requests)),
+                "x-ratelimit-remaining-tokens": str(max(0, self.token_limit - self.window_tokens)),
+                "x-ratelimit-reset-requests": f"{reset * (self.window_requests / self.request_limit):.3f}s",
+                "x-ratelimit-reset-tokens": f"{reset * (self.window_tokens / self.token_limit):.3f}s"
+            }
+            if throttle:
+                headers["retry-after"] = "0.05"
+            return throttle, headers
+
+class MockOpenAIHandler(MockHandler):
+    def do_POST(self):
+        self.begin()
+        request = json.loads(self.read_body())
+        messages = request.get("messages", [])
+        # About 4 characters per token is close enough for a stand-in
+        prompt_tokens = sum(len(message.get("content", "")) for message in messages) // 4
+        throttled, headers = self.server.use_budget(prompt_tokens + request.get("max_tokens", 0))
+        if throttled:
+            self.send(429, json.dumps({"error": {"message": "Rate limit reached"}}), headers=headers)
+            return
+
+        # The diff is the user message, which comes first when several review types share it
+        user_content = next((message.get("content", "") for message in messages if message.get("role") == "user"), "")
+        # One review per file, the way the prompts ask for it when several files share a request
+        filenames = re.findall(r"^diff --git a/\S+ b/(\S+)", user_content, re.MULTILINE) or ["unknown"]
+        review = "\n\n".join(f"File: {filename}\nLooks good overall.\n- Consider adding tests.\n- Naming is consistent."
+                             for filename in filenames)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(review) // 4,
+                 "total_tokens": prompt_tokens + len(review) // 4}
+
+        if not request.get("stream"):
+            body = {"choices": [{"message": {"role": "assistant", "content": review}}], "usage": usage}
+            self.send(200, json.dumps(body), headers=headers)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        for word in re.findall(r"\S+\s*", review):
+            self.write_event({"choices": [{"delta": {"content": word}}]})
+            if self.server.stream_delay:
+                time.sleep(self.server.stream_delay)
+        self.write_event({"choices": [], "usage": usage})
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+    def write_event(self, payload):
+        self.wfile.write(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+        self.wfile.flush()
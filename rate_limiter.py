@@ -1,79 +1,261 @@
+import re
 import time
-import requests
 import json
+import random
+import asyncio
+import threading
+import requests
+
+# Responses that are worth retrying after a backoff
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+class TokenBucket:
+    """A bucket that refills continuously up to its capacity.
+
+    OpenAI limits are per minute, so by default the bucket refills its full capacity
+    every 60 seconds. The rate is adjusted from the reset headers of each response.
+    A capacity of None means no limit, until a response reports one.
+    """
+    def __init__(self, capacity, period=60.0):
+        self.capacity = capacity
+        self.period = period
+        self.rate = capacity / period if capacity is not None else None
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        if self.capacity is not None:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until amount can be taken from the bucket (0 if it can be taken now)."""
+        if self.capacity is None:
+            return 0
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount):
+        if self.capacity is not None:
+            self.level -= min(amount, self.capacity)
+
+    def update(self, limit, remaining, reset_seconds, in_flight, now):
+        """Sync the bucket with the limit, remaining and reset values reported by the server."""
+        self.refill(now)
+        if limit:
+            if self.capacity is None:
+                self.level = limit
+            self.capacity = limit
+            self.rate = limit / self.period
+            if remaining is not None and remaining < limit and reset_seconds:
+                # The server refills (limit - remaining) in reset_seconds
+                self.rate = max(self.rate, (limit - remaining) / reset_seconds)
+        if remaining is not None and self.capacity is not None:
+            # The server hasn't counted the requests that are still in flight
+            self.level = min(self.capacity, remaining - in_flight)
 
 class RateLimiter:
-    def __init__(self, max_requests, max_tokens):
+    """Schedules requests so they stay within the OpenAI request and token limits.
+
+    Each request reserves one request and its estimated prompt + completion tokens before
+    it is sent, waiting for the buckets to refill if needed. The buckets are synced with the
+    x-ratelimit-* headers of every response. Throttled and failed requests are retried with
+    jittered exponential backoff, up to max_retries times. A POST that times out waiting for
+    its response isn't retried: the server may still be generating (and billing) it.
+
+    The limiter can be shared between threads, and reserve_async can be used from asyncio code.
+    """
+    def __init__(self, max_requests, max_tokens, max_retries=5, base_backoff=1.0, max_backoff=60.0, http_client=None,
+                 metrics=None, timeout=None):
         self.max_requests = max_requests
         self.max_tokens = max_tokens
-        self.remaining_requests = max_requests
-        self.remaining_tokens = max_tokens
-        self.reset_requests_interval = None
-        self.reset_tokens_interval = None
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.http_client = http_client  # A pooled HttpClient, or None to use plain requests
+        self.metrics = metrics          # A Metrics object to record latency, retries and waits in, or None
+        self.timeout = timeout          # (connect, read) seconds, or None for the client's default
+        self.request_bucket = TokenBucket(max_requests)
+        self.token_bucket = TokenBucket(max_tokens)
+        self.in_flight_requests = 0
+        self.in_flight_tokens = 0
+        self.blocked_until = 0      # Set when the server throttles us, so every caller backs off
+        self.lock = threading.Lock()
+        # Notified whenever a response updates the buckets, so waiting callers can check again early
+        self.changed = threading.Condition(self.lock)
 
     @staticmethod
     def duration_to_seconds(duration):
-        """Converts a duration string (e.g., 1h30m15s) to seconds."""
+        """Converts a duration string (e.g., 1h30m15s, 6m0s, 20ms) to seconds."""
+        units = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
         total_seconds = 0
+        for value, unit in re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', duration or ''):
+            total_seconds += float(value) * units[unit]
+        return total_seconds
 
-        # Hours to seconds
-        hours = 0
-        if 'h' in duration:
-            hours, duration = duration.split('h')
-            total_seconds += int(hours) * 3600
+    @staticmethod
+    def estimate_tokens(data):
+        """Roughly estimate the prompt + completion tokens of a chat request (about 4 characters per token)."""
+        if not data:
+            return 0
+        characters = sum(len(message.get('content', '')) for message in data.get('messages', []))
+        return characters // 4 + data.get('max_tokens', 0)
 
-        # Minutes to seconds
-        minutes = 0
-        if 'm' in duration:
-            minutes, duration = duration.split('m')
-            total_seconds += int(minutes) * 60
+    def try_reserve(self, estimated_tokens):
+        """Reserve a request and its tokens if the buckets allow it.
 
-        # Seconds (if any left in the string)
-        if 's' in duration:
-            seconds = int(float(duration.split('s')[0]))
-            total_seconds += seconds
+        Returns:
+        - 0 if the request was reserved, otherwise the number of seconds to wait before trying again.
+        """
+        with self.lock:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            self.request_bucket.refill(now)
+            self.token_bucket.refill(now)
+            wait = max(self.request_bucket.wait_time(1), self.token_bucket.wait_time(estimated_tokens))
+            if wait > 0:
+                return wait
+            self.request_bucket.take(1)
+            self.token_bucket.take(estimated_tokens)
+            self.in_flight_requests += 1
+            self.in_flight_tokens += estimated_tokens
+            return 0
 
-        return total_seconds
+    def reserve(self, estimated_tokens):
+        while True:
+            wait = self.try_reserve(estimated_tokens)
+            if wait <= 0:
+                return
+            self.wait_until_reset(wait)
+
+    async def reserve_async(self, estimated_tokens):
+        while True:
+            wait = self.try_reserve(estimated_tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+            if self.metrics is not None:
+                self.metrics.increment("rate_limit_sleep_seconds", wait)
+
+    def release(self, estimated_tokens, response_headers=None):
+        """Mark a reserved request as finished and sync the buckets with the response headers."""
+        with self.lock:
+            self.in_flight_requests -= 1
+            self.in_flight_tokens -= estimated_tokens
+            self.changed.notify_all()
+            if response_headers is None:
+                return
+            now = time.monotonic()
+            self.request_bucket.update(
+                self.header_int(response_headers, 'x-ratelimit-limit-requests'),
+                self.header_int(response_headers, 'x-ratelimit-remaining-requests'),
+                self.duration_to_seconds(response_headers.get('x-ratelimit-reset-requests')),
+                self.in_flight_requests, now)
+            self.token_bucket.update(
+                self.header_int(response_headers, 'x-ratelimit-limit-tokens'),
+                self.header_int(response_headers, 'x-ratelimit-remaining-tokens'),
+                self.duration_to_seconds(response_headers.get('x-ratelimit-reset-tokens')),
+                self.in_flight_tokens, now)
+
+    @staticmethod
+    def header_int(headers, name):
+        value = headers.get(name)
+        try:
+            return int(value) if value is not None else None
+        except ValueError:
+            return None
 
-    def wait_until_reset(self):
-        now = time.time()
-        if self.reset_requests_interval and now < self.reset_requests_interval:
-            time.sleep(self.reset_requests_interval - now)
-        elif self.reset_tokens_interval and now < self.reset_tokens_interval:
-            time.sleep(self.reset_tokens_interval - now)
+    def backoff_delay(self, attempt, response=None):
+        """Jittered exponential backoff, but never shorter than the reset time the server asks for."""
+        delay = min(self.max_backoff, self.base_backoff * (2 ** attempt)) * random.uniform(0.5, 1.0)
+        if response is not None:
+            retry_after = response.headers.get('retry-after')
+            if retry_after:
+                try:
+                    delay = max(delay, float(retry_after))
+                except ValueError:
+                    pass
+            for header in ('x-ratelimit-reset-requests', 'x-ratelimit-reset-tokens'):
+                if response.headers.get(header) and self.header_int(response.headers, header.replace('reset', 'remaining')) == 0:
+                    delay = max(delay, self.duration_to_seconds(response.headers.get(header)))
+        return delay
 
-    def make_request(self, url, method='GET', headers=None, data=None):
-        self.wait_until_reset()
+    def wait_until_reset(self, seconds):
+        """Wait up to seconds for the limits to reset. Returns early if a response updates the buckets."""
+        start = time.monotonic()
+        with self.changed:
+            self.changed.wait(seconds)
+        if self.metrics is not None:
+            self.metrics.increment("rate_limit_sleep_seconds", time.monotonic() - start)
 
-        if self.remaining_requests <= 0 or self.remaining_tokens <= 0:
-            # If no requests or tokens are left, sleep and reset
-            time.sleep(60)
-            self.remaining_requests = self.max_requests
-            self.remaining_tokens = self.max_tokens
+    def wait_until(self, deadline):
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            self.wait_until_reset(remaining)
 
+    def send_request(self, url, method, headers, data, stream=False):
+        client = self.http_client or requests
+        kwargs = {"timeout": self.timeout} if self.timeout is not None else {}
         if method == 'GET':
-            response = requests.get(url, headers=headers)
+            return client.get(url, headers=headers, stream=stream, **kwargs)
         elif method == 'POST':
-            response = requests.post(url, headers=headers, data=json.dumps(data))
+            return client.post(url, headers=headers, data=json.dumps(data), stream=stream, **kwargs)
         else:
             raise ValueError("Unsupported HTTP method")
 
-        if response.status_code == 429:
-            # Rate limit exceeded
-            reset_requests = response.headers.get('x-ratelimit-reset-requests')
-            reset_tokens = response.headers.get('x-ratelimit-reset-tokens')
+    def make_request(self, url, method='GET', headers=None, data=None, estimated_tokens=None, stream=False):
+        """Send a request once the rate limits allow it, retrying throttled and failed requests.
+        With stream=True the response body is left unread for the caller to iterate.
 
-            if reset_requests:
-                self.reset_requests_interval = time.time() + self.duration_to_seconds(reset_requests)
+        Returns:
+        - The response. After max_retries failed attempts the last response is returned as is.
+        """
+        if estimated_tokens is None:
+            estimated_tokens = self.estimate_tokens(data)
 
-            if reset_tokens:
-                self.reset_tokens_interval = time.time() + self.duration_to_seconds(reset_tokens)
+        for attempt in range(self.max_retries + 1):
+            self.reserve(estimated_tokens)
+            if attempt and self.metrics is not None:
+                self.metrics.increment("retries")
+            started = time.perf_counter()
+            try:
+                response = self.send_request(url, method, headers, data, stream)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.release(estimated_tokens)
+                if self.metrics is not None:
+                    self.metrics.increment("connection_errors")
+                if attempt == self.max_retries or (method == 'POST' and isinstance(e, requests.ReadTimeout)):
+                    raise
+                self.wait_until(time.monotonic() + self.backoff_delay(attempt))
+                continue
+            except Exception:
+                self.release(estimated_tokens)
+                raise
 
-            self.wait_until_reset()
-            return self.make_request(url, method, headers, data)  # Retry the request
+            self.release(estimated_tokens, response.headers)
+            if self.metrics is not None:
+                # A streamed body is still to be read, its total time is recorded by whoever reads it
+                streamed = stream and response.status_code == 200
+                self.metrics.observe("first_byte_seconds" if streamed else "request_seconds", time.perf_counter() - started)
+                self.metrics.increment("requests")
+                if response.status_code == 429:
+                    self.metrics.increment("throttled")
+                elif response.status_code != 200:
+                    self.metrics.increment("request_errors")
+            if response.status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                return response
+            response.close()
 
-        if response.status_code == 200:
-            self.remaining_requests = int(response.headers.get('x-ratelimit-remaining-requests'))
-            self.remaining_tokens = int(response.headers.get('x-ratelimit-remaining-tokens'))
+            retry_at = time.monotonic() + self.backoff_delay(attempt, response)
+            if response.status_code == 429:
+                # Hold off every caller, not just this one
+                with self.lock:
+                    self.blocked_until = max(self.blocked_until, retry_at)
+            self.wait_until(retry_at)
 
         return response
@@ -0,0 +1,46 @@
+import json
+import hashlib
+import threading
+from sqlite_lru import SQLiteLRUStore
+
+class ReviewCache:
+    """A persistent cache of file reviews stored in SQLite.
+
+    Reviews are keyed on a hash of everything that affects the review: the file's diff,
+    the prompt, the model and the response size. When the cache grows past max_bytes the
+    least recently used reviews are evicted.
+    """
+    def __init__(self, path, max_bytes=50 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.store = SQLiteLRUStore(path, "reviews", ("review TEXT NOT NULL",), max_bytes)
+
+    @staticmethod
+    def make_key(file_segment, prompt, model, max_tokens):
+        """Hash the inputs of a review into a cache key."""
+        payload = json.dumps([file_segment, prompt, model, max_tokens])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Return the cached review for key, or None if it isn't cached."""
+        row = self.store.get(key)
+        with self.lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return row[0]
+
+    def set(self, key, review):
+        """Store a review and evict old reviews if the cache is over its size limit."""
+        self.store.set(key, (review,), len(review.encode("utf-8")))
+
+    def stats(self):
+        """Return a short summary of cache hits and misses."""
+        return f"Review cache: {self.hits} hits, {self.misses} misses"
+
+    def close(self):
+        self.store.close()
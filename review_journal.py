@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+class ReviewJournal:
+    """An append-only JSONL journal of the file reviews of one pull request.
+
+    There is one journal per PR, head SHA and prompt (see make_path). Every finished or
+    failed file review is appended as soon as it is known, so a run that dies halfway can
+    be resumed without paying for the files that were already reviewed. Files are identified
+    by a hash of their diff and the model, so a file is only reused if it would be reviewed
+    exactly the same way.
+
+    Only the offset of each file's latest record is kept in memory; reviews are read back
+    from disk when they are needed.
+    """
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.offsets = {}       # Entry key -> (offset of its latest record, status)
+        self.order = []         # Entry keys of the files being reviewed, in diff order
+        self.lock = threading.Lock()
+        self.closed = False
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        complete = None
+        if resume and os.path.exists(path):
+            complete = self.load()
+        # Binary mode so tell() gives byte offsets that can be seeked to when reading back
+        self.file = open(path, "ab" if resume else "wb")
+        if complete is not None and complete < self.file.tell():
+            # Drop a record cut off by a crash, or the next record would be appended to it
+            self.file.truncate(complete)
+            self.file.seek(complete)
+
+    @staticmethod
+    def make_path(directory, owner, repo, pr_number, head_sha, prompt):
+        prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:12]
+        return os.path.join(directory, f"{owner}-{repo}-{pr_number}-{head_sha[:12]}-{prompt_hash}.jsonl")
+
+    @staticmethod
+    def make_key(file_segment, model):
+        """Identify a file review by its diff and model."""
+        return hashlib.sha256(json.dumps([file_segment, model]).encode("utf-8")).hexdigest()
+
+    def load(self):
+        """Index the records of an existing journal. A record cut off by a crash is ignored.
+
+        Returns:
+        - The size in bytes of the complete lines of the journal.
+        """
+        offset = 0
+        with open(self.path, "rb") as file:
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                    self.offsets[record["key"]] = (offset, record["status"])
+                except (ValueError, KeyError):
+                    pass
+                offset += len(line)
+        return offset
+
+    def append(self, record):
+        """Append a record, unless the journal is closed.
+
+        A cancelled review closes its journal without waiting for the files that were already
+        being reviewed, so their records are dropped rather than written to a closed file.
+        """
+        data = (json.dumps(record) + "\n").encode("utf-8")
+        with self.lock:
+            if self.closed:
+                return
+            offset = self.file.tell()
+            self.file.write(data)
+            # Flushed right away so the record survives the process being killed
+            self.file.flush()
+            self.offsets[record["key"]] = (offset, record["status"])
+
+    def record_review(self, key, filename, review):
+        self.append({"key": key, "file": filename, "status": "done", "review": review, "time": time.time()})
+
+    def record_failure(self, key, filename, error, attempt):
+        self.append({"key": key, "file": filename, "status": "failed", "error": str(error), "attempt": attempt,
+                     "time": time.time()})
+
+    def is_done(self, key):
+        return self.offsets.get(key, (None, None))[1] == "done"
+
+    def read(self, key):
+        """Read the latest record of a file back from the journal, or None if there is none."""
+        with self.lock:
+            if key not in self.offsets:
+                return None
+            offset = self.offsets[key][0]
+            if not self.closed:
+                self.file.flush()
+        with open(self.path, "rb") as file:
+            file.seek(offset)
+            return json.loads(file.readline())
+
+    def get_review(self, key):
+        record = self.read(key)
+        return record["review"] if record is not None and record["status"] == "done" else None
+
+    def iter_reviews(self):
+        """Yield the review (or the error) of each file in diff order, one at a time."""
+        for _, review in self.iter_file_reviews():
+            yield review
+
+    def get_file_review(self, key):
+        """Return the file name and review (or error) recorded for a file, or None if there is no record."""
+        record = self.read(key)
+        if record is None:
+            return None
+        if record["status"] == "done":
+            return record["file"], record["review"]
+        return record["file"], f"File: {record['file']}\nReview failed due to an error: {record['error']}"
+
+    def iter_file_reviews(self):
+        """Yield the file name and review (or error) of each file in diff order, one at a time."""
+        for key in self.order:
+            file_review = self.get_file_review(key)
+            if file_review is not None:
+                yield file_review
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.file.close()
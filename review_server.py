@@ -0,0 +1,185 @@
+import hmac
+import json
+import hashlib
+import threading
+import collections
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# pull_request webhook actions that mean there is new code to review
+REVIEW_ACTIONS = ('opened', 'reopened', 'synchronize', 'ready_for_review')
+
+class ReviewJob:
+    """A request to review one pull request at a given head commit."""
+    def __init__(self, owner, repo, pr_number, head_sha):
+        self.owner = owner
+        self.repo = repo
+        self.pr_number = pr_number
+        self.head_sha = head_sha
+        self.key = (owner, repo, pr_number)
+        self.cancelled = threading.Event()  # Set when a newer push supersedes this job
+
+    def __str__(self):
+        return f"{self.owner}/{self.repo}#{self.pr_number}@{self.head_sha[:7]}"
+
+class ReviewJobQueue:
+    """A queue of review jobs worked by a pool of threads.
+
+    There is at most one pending job per pull request: a newer head SHA replaces the
+    pending job and cancels the running one, and repeated deliveries of the same SHA
+    are dropped. Jobs for the same pull request never run at the same time.
+    """
+    def __init__(self, handle_job, workers=2):
+        self.handle_job = handle_job
+        self.pending = collections.OrderedDict()
+        self.running = {}
+        self.stopping = False
+        self.condition = threading.Condition()
+        self.threads = [threading.Thread(target=self.work, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, job):
+        """Queue a job. Returns False if the same commit is already queued or being reviewed."""
+        with self.condition:
+            for queued in (self.pending.get(job.key), self.running.get(job.key)):
+                if queued is not None and queued.head_sha == job.head_sha and not queued.cancelled.is_set():
+                    return False
+            running = self.running.get(job.key)
+            if running is not None:
+                running.cancelled.set()
+            superseded = self.pending.pop(job.key, None)
+            if superseded is not None:
+                superseded.cancelled.set()
+            self.pending[job.key] = job
+            self.condition.notify_all()
+            return True
+
+    def next_job(self):
+        """Wait for a pending job whose pull request isn't already being reviewed."""
+        with self.condition:
+            while True:
+                if self.stopping:
+                    return None
+                for key, job in self.pending.items():
+                    if key not in self.running:
+                        del self.pending[key]
+                        self.running[key] = job
+                        return job
+                self.condition.wait()
+
+    def work(self):
+        while True:
+            job = self.next_job()
+            if job is None:
+                return
+            try:
+                self.handle_job(job)
+            except Exception as e:
+                print(f"Review of {job} failed: {e}")
+            finally:
+                with self.condition:
+                    del self.running[job.key]
+                    self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {"pending": len(self.pending), "running": len(self.running)}
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            for job in self.running.values():
+                job.cancelled.set()
+            self.condition.notify_all()
+
+def verify_signature(secret, body, signature):
+    """Check the X-Hub-Signature-256 header GitHub signs webhook deliveries with.
+
+    Without a secret nothing can be checked, which the server only allows on a loopback address.
+    """
+    if not secret:
+        return True
+    expected = "sha256=" + hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature or "")
+
+def job_from_payload(payload):
+    """Build a review job from a pull_request webhook payload, or None if there is nothing to review."""
+    pull_request = payload.get("pull_request")
+    if payload.get("action") not in REVIEW_ACTIONS or not pull_request or pull_request.get("draft"):
+        return None
+    repository = payload["repository"]
+    return ReviewJob(repository["owner"]["login"], repository["name"], pull_request["number"], pull_request["head"]["sha"])
+
+def is_loopback(host):
+    """Check if the server would only be reachable from this machine."""
+    return host in ("localhost", "::1") or host.startswith("127.")
+
+class ReviewServer(ThreadingHTTPServer):
+    """A small HTTP server that turns GitHub pull_request webhooks into review jobs.
+
+    POST any path with a webhook delivery to queue a review, GET /healthz to check the queue.
+    Extra GET routes can be added to get_routes as path -> function returning (content type, body).
+    """
+    daemon_threads = True
+
+    def __init__(self, address, job_queue, secret=None, repos=None):
+        """
+        Parameters:
+        - secret: The webhook secret deliveries must be signed with. Without one, address must be a loopback address.
+        - repos: The "owner/repo" names reviews are queued for, or None for any repository.
+        """
+        if not secret and not is_loopback(address[0]):
+            raise ValueError("A webhook secret is required to listen on a non-loopback address")
+        super().__init__(address, WebhookHandler)
+        self.job_queue = job_queue
+        self.secret = secret
+        self.repos = None if repos is None else {name.lower() for name in repos}
+        self.get_routes = {
+            "/healthz": lambda: ("application/json", json.dumps(job_queue.stats()))
+        }
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def send(self, status, body, content_type="application/json"):
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        route = self.server.get_routes.get(self.path.split("?")[0])
+        if route is None:
+            self.send(404, json.dumps({"error": "not found"}))
+            return
+        content_type, body = route()
+        self.send(200, body, content_type)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not verify_signature(self.server.secret, body, self.headers.get("X-Hub-Signature-256")):
+            self.send(401, json.dumps({"error": "invalid signature"}))
+            return
+        event = self.headers.get("X-GitHub-Event")
+        if event == "ping":
+            self.send(200, json.dumps({"ok": True}))
+            return
+        if event != "pull_request":
+            self.send(202, json.dumps({"queued": False, "reason": f"ignored event {event}"}))
+            return
+        try:
+            job = job_from_payload(json.loads(body))
+        except (ValueError, KeyError, TypeError):
+            self.send(400, json.dumps({"error": "invalid pull_request payload"}))
+            return
+        if job is None:
+            self.send(202, json.dumps({"queued": False, "reason": "nothing to review"}))
+            return
+        if self.server.repos is not None and f"{job.owner}/{job.repo}".lower() not in self.server.repos:
+            self.send(403, json.dumps({"queued": False, "reason": f"{job.owner}/{job.repo} is not a configured repository"}))
+            return
+        queued = self.server.job_queue.submit(job)
+        self.send(202, json.dumps({"queued": queued, "job": str(job)}))
+
+    def log_message(self, format, *args):
+        pass
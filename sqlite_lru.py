@@ -0,0 +1,76 @@
+import time
+import sqlite3
+import threading
+
+class SQLiteLRUStore:
+    """A table of values stored in SQLite by key, evicting the least recently used past max_bytes.
+
+    Used by ReviewCache and GitHubCache. Each row has a key, the value columns, the size the
+    row counts for and when it was last used.
+    """
+    def __init__(self, path, table, columns, max_bytes):
+        """
+        Parameters:
+        - table: The name of the table.
+        - columns: The definitions of the value columns, e.g. ("review TEXT NOT NULL",).
+        - max_bytes: The total size past which rows are evicted. A single row larger than this isn't stored.
+        """
+        self.path = path
+        self.table = table
+        self.columns = [column.split()[0] for column in columns]
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            f"key TEXT PRIMARY KEY, {', '.join(columns)}, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.commit()
+
+    def get(self, key):
+        """Return the value columns stored for key as a tuple, or None if it isn't stored."""
+        with self.lock:
+            row = self.conn.execute(
+                f"SELECT {', '.join(self.columns)} FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(f"UPDATE {self.table} SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+            return row
+
+    def set(self, key, values, size):
+        """Store the value columns for key and evict old rows if the store is over its size limit.
+
+        Returns:
+        - False if the row alone is larger than max_bytes and wasn't stored.
+        """
+        if size > self.max_bytes:
+            return False
+        placeholders = ", ".join("?" for _ in range(len(self.columns) + 3))
+        with self.lock:
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, {', '.join(self.columns)}, size, last_used) "
+                f"VALUES ({placeholders})",
+                (key, *values, size, time.time())
+            )
+            self.evict(key)
+            self.conn.commit()
+        return True
+
+    def evict(self, keep=None):
+        """Delete the least recently used rows, other than keep, until the store fits in max_bytes."""
+        total = self.conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {self.table}").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        stale = []
+        for key, size in self.conn.execute(
+                f"SELECT key, size FROM {self.table} WHERE key != ? ORDER BY last_used ASC", (keep or "",)):
+            if total <= self.max_bytes:
+                break
+            stale.append((key,))
+            total -= size
+        self.conn.executemany(f"DELETE FROM {self.table} WHERE key = ?", stale)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,45 @@
+import threading
+
+class OrderedStreamWriter:
+    """Writes file reviews as they stream in, keeping the files in their original order.
+
+    Files can be reviewed concurrently, but only the earliest unfinished file is written
+    live. Text for later files is buffered and written as soon as every file before them
+    has finished, so the output reads exactly like the non-streamed review.
+    """
+    def __init__(self, output, separator="\n\n"):
+        self.output = output
+        self.separator = separator
+        self.current = 0        # The file being written live
+        self.buffers = {}
+        self.finished = set()
+        self.started = set()
+        self.lock = threading.Lock()
+
+    def write(self, idx, text):
+        with self.lock:
+            if idx == self.current:
+                self.emit(idx, text)
+            else:
+                self.buffers.setdefault(idx, []).append(text)
+
+    def finish(self, idx):
+        """Mark a file as done and move on to the next file that hasn't been written yet."""
+        with self.lock:
+            self.finished.add(idx)
+            while self.current in self.finished:
+                self.current += 1
+                buffered = self.buffers.pop(self.current, None)
+                if buffered:
+                    self.emit(self.current, "".join(buffered))
+
+    def emit(self, idx, text):
+        if not text:
+            return
+        if idx not in self.started:
+            # Separate the reviews of different files
+            if self.started:
+                self.output.write(self.separator)
+            self.started.add(idx)
+        self.output.write(text)
+        self.output.flush()
@@ -0,0 +1,19 @@
+import os
+import sys
+import importlib.util
+import pytest
+
+# The modules live next to code-review.py, at the root of the repository
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def load_code_review():
+    """Import code-review.py, which can't be imported by name because of the dash."""
+    spec = importlib.util.spec_from_file_location("code_review", os.path.join(ROOT, "code-review.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+@pytest.fixture(scope="session")
+def code_review():
+    return load_code_review()
@@ -0,0 +1,3 @@
+def test_segment_diff_by_files_splits_text_only_on_newlines(code_review):
+    diff = "diff --git a/a.py b/a.py\n@@ -1 +1 @@\n-x\n+s = '\x0cdiff --git a/evil b/evil'"
+    assert code_review.segment_diff_by_files(diff) == [diff]
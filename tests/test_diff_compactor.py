@@ -0,0 +1,52 @@
+import pytest
+from diff_compactor import DiffCompactor
+from diff_parser import parse_diff
+
+def test_trim_context_splits_hunk_and_renumbers_lines():
+    hunk = ["@@ -10,12 +10,12 @@ def main():"] + [" c%d" % n for n in range(1, 3)] + ["-old", "+new"] \
+        + [" c%d" % n for n in range(3, 11)] + ["+added"]
+    first, second = DiffCompactor(context_lines=1).trim_context(hunk)
+    assert first == ["@@ -11,3 +11,3 @@ def main():", " c2", "-old", "+new", " c3"]
+    # -old is old line 12 and +new new line 12, so c10 is line 20 on both sides
+    assert second == ["@@ -20,1 +20,2 @@ def main():", " c10", "+added"]
+
+def test_trim_context_points_an_empty_side_at_the_line_before():
+    hunk = ["@@ -1,6 +1,5 @@"] + [" a", " b", " c", " d", " e", "-f"]
+    assert DiffCompactor(context_lines=0).trim_context(hunk) == [["@@ -6,1 +5,0 @@", "-f"]]
+
+def test_trim_context_keeps_short_hunks_as_they_are():
+    hunk = ["@@ -1,3 +1,3 @@", " a", "-b", "+c", " d"]
+    assert DiffCompactor(context_lines=3).trim_context(hunk) == [hunk]
+    assert DiffCompactor(context_lines=None).trim_context(hunk + [" e"] * 10) == [hunk + [" e"] * 10]
+
+def test_indentation_changes_are_not_whitespace_only():
+    compactor = DiffCompactor()
+    reindented = ["@@ -1,2 +1,2 @@", "-if ok:", "-    run()", "+if ok:", "+run()"]
+    assert compactor.summarize_hunk(reindented) == reindented
+    trailing = ["@@ -1,2 +1,2 @@", "-x = 1  ", "+x = 1", "+"]
+    assert compactor.summarize_hunk(trailing) == ["@@ -1,2 +1,2 @@", "[whitespace-only changes to 2 lines omitted]"]
+
+def test_whitespace_inside_a_line_is_a_real_change():
+    hunk = ["@@ -1 +1 @@", '-sep = "a  b"', '+sep = "a b"']
+    assert DiffCompactor().summarize_hunk(hunk) == hunk
+
+def test_deletions_are_kept_by_default():
+    hunk = ["@@ -1,2 +0,0 @@", "-check()", "-validate()"]
+    assert DiffCompactor().summarize_hunk(hunk) == hunk
+    assert DiffCompactor(deletion_hunks="drop").summarize_hunk(hunk) is None
+
+def test_compact_strips_headers_and_leaves_the_original_alone():
+    file_diff = next(parse_diff(["diff --git a/a.py b/a.py", "index 1..2 100644", "--- a/a.py", "+++ b/a.py",
+                                 "@@ -1 +1 @@", "-x", "+y"]))
+    compacted = DiffCompactor().compact(file_diff)
+    assert compacted.lines == ["diff --git a/a.py b/a.py", "@@ -1 +1 @@", "-x", "+y"]
+    assert len(file_diff.header) == 4
+
+def test_skip_paths_and_settings():
+    compactor = DiffCompactor.from_settings({"SKIP_PATHS": "vendor/*, *.pb.go", "COMPACT_CONTEXT_LINES": "-1",
+                                             "COMPACT_STRIP_HEADERS": "false"})
+    assert (compactor.context_lines, compactor.strip_headers) == (None, False)
+    assert compactor.should_skip(next(parse_diff(["diff --git a/src/vendor/x.go b/src/vendor/x.go"])))
+    assert not compactor.should_skip(next(parse_diff(["diff --git a/src/x.go b/src/x.go"])))
+    with pytest.raises(ValueError):
+        DiffCompactor(whitespace_hunks="hide")
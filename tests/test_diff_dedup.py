@@ -0,0 +1,52 @@
+import pytest
+from diff_dedup import HunkDeduplicator
+from diff_parser import parse_diff
+
+def make_file(name, *hunks, start=1):
+    lines = [f"diff --git a/{name} b/{name}"]
+    for hunk in hunks:
+        lines += [f"@@ -{start},2 +{start},2 @@"] + list(hunk)
+    return next(parse_diff(lines))
+
+RENAME = ["-old_name(config)", "-old_name(other)", "+new_name(config)", "+new_name(other)"]
+
+def test_a_file_repeating_an_earlier_file_is_a_duplicate():
+    files = [make_file("a.py", RENAME), make_file("b.py", [line + "  " for line in RENAME], start=40),
+             make_file("c.py", ["-x = 1", "-y = 2", "+x = 2", "+y = 3"])]
+    results = HunkDeduplicator().deduplicate(files)
+    assert [result["duplicate_of"] for result in results] == [None, 0, None]
+    assert results[1]["similarity"] == 1.0
+
+def test_a_shared_hunk_is_replaced_by_a_note():
+    own = ["-a = 1", "-b = 2", "+a = 2", "+b = 3"]
+    results = HunkDeduplicator().deduplicate([make_file("a.py", RENAME), make_file("b.py", RENAME, own)])
+    second = results[1]
+    assert second["duplicate_of"] is None and second["shared_hunks"] == 1
+    assert second["file_diff"].hunks == [["@@ -1,2 +1,2 @@", "[same change as in a.py, reviewed there]"],
+                                         ["@@ -1,2 +1,2 @@"] + own]
+
+def test_the_caller_files_are_not_changed():
+    files = [make_file("a.py", RENAME), make_file("b.py", RENAME, ["-a = 1", "-b = 2", "+a = 2", "+b = 3"])]
+    HunkDeduplicator().deduplicate(files)
+    assert files[1].hunks[0] == ["@@ -1,2 +1,2 @@"] + RENAME
+
+def test_files_with_generic_one_line_hunks_are_never_duplicates():
+    generic = ["+    return None"]
+    results = HunkDeduplicator().deduplicate([make_file("auth.py", generic), make_file("billing.py", generic)])
+    assert [result["duplicate_of"] for result in results] == [None, None]
+    assert results[1]["shared_hunks"] == 0
+
+def test_near_duplicates_with_similarity():
+    first = ["-call(a, b, c)", "-call(d, e, f)", "+call(a, b, c, timeout=5)", "+call(d, e, f, timeout=5)"]
+    second = ["-call(a, b, c)", "-call(d, e, g)", "+call(a, b, c, timeout=5)", "+call(d, e, g, timeout=5)"]
+    files = [make_file("a.py", first), make_file("b.py", second)]
+    assert HunkDeduplicator().deduplicate(files)[1]["duplicate_of"] is None
+    result = HunkDeduplicator(similarity=0.5).deduplicate(files)[1]
+    assert result["duplicate_of"] == 0 and 0.5 <= result["similarity"] < 1
+
+def test_settings():
+    deduplicator = HunkDeduplicator.from_settings({"DEDUP_SIMILARITY": "0.9", "DEDUP_MIN_HUNK_LINES": "3"})
+    assert (deduplicator.similarity, deduplicator.min_hunk_lines) == (0.9, 3)
+    assert HunkDeduplicator.from_settings({}).similarity is None
+    with pytest.raises(ValueError):
+        HunkDeduplicator(similarity=1.5)
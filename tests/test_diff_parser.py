@@ -0,0 +1,68 @@
+from diff_parser import parse_diff, should_review, split_lines
+
+DIFF = """diff --git a/app.py b/app.py
+index 1111111..2222222 100644
+--- a/app.py
++++ b/app.py
+@@ -1,3 +1,3 @@
+ import os
+-x = 1
++x = 2
+diff --git a/old.py b/new.py
+similarity index 100%
+rename from old.py
+rename to new.py
+diff --git a/gone.py b/gone.py
+deleted file mode 100644
+--- a/gone.py
++++ /dev/null
+@@ -1 +0,0 @@
+-print("bye")
+diff --git a/logo.png b/logo.png
+Binary files a/logo.png and b/logo.png differ
+diff --git a/static/app.min.js b/static/app.min.js
+--- a/static/app.min.js
++++ b/static/app.min.js
+@@ -1 +1 @@
+-a()
++b()"""
+
+def parse(text):
+    return list(parse_diff(split_lines([text])))
+
+def test_parse_diff_splits_files_and_counts_changes():
+    files = parse(DIFF)
+    assert [f.filename for f in files] == ["app.py", "new.py", "gone.py", "logo.png", "static/app.min.js"]
+    assert [f.status for f in files] == ["modified", "renamed", "deleted", "binary", "modified"]
+    app = files[0]
+    assert (app.additions, app.deletions) == (1, 1)
+    assert app.hunks == [["@@ -1,3 +1,3 @@", " import os", "-x = 1", "+x = 2"]]
+    assert files[1].old_filename == "old.py"
+
+def test_should_review_skips_deleted_binary_renamed_and_minified_files():
+    assert [should_review(f) for f in parse(DIFF)] == [True, False, False, False, False]
+
+def test_renamed_file_with_changes_is_reviewed():
+    files = parse("diff --git a/a.py b/b.py\nrename from a.py\nrename to b.py\n@@ -1 +1 @@\n-x\n+y")
+    assert files[0].status == "renamed"
+    assert should_review(files[0])
+
+def test_control_characters_in_a_line_dont_start_a_new_file():
+    text = "diff --git a/a.py b/a.py\n@@ -1 +1 @@\n-x\n+s = '\x0cdiff --git a/evil b/evil'"
+    files = parse(text)
+    assert [f.filename for f in files] == ["a.py"]
+    assert files[0].hunks[0][-1] == "+s = '\x0cdiff --git a/evil b/evil'"
+
+def test_split_lines_joins_lines_across_chunks():
+    assert list(split_lines(["ab", "c\r\nd", "e\n", "f"])) == ["abc", "de", "f"]
+
+def test_max_chars_drops_hunk_lines_past_the_budget():
+    text = "\n".join(["diff --git a/a.py b/a.py", "@@ -1,2 +1,2 @@", "-aaaa", "+bbbb",
+                      "diff --git a/b.py b/b.py", "@@ -1 +1 @@", "-cccc", "+dddd",
+                      "diff --git a/yarn.lock b/yarn.lock", "@@ -1 +1 @@", "-x", "+y"])
+    a, b, lock = parse_diff(split_lines([text]), max_chars=40)
+    assert (a.hunks, a.dropped_lines) == ([["@@ -1,2 +1,2 @@", "-aaaa", "+bbbb"]], 0)
+    assert b.hunks == [["@@ -1 +1 @@"]] and b.dropped_lines == 2
+    # Lockfiles have their own budget, so they don't take the source files' share
+    assert lock.hunks == [["@@ -1 +1 @@", "-x", "+y"]]
+    assert should_review(b)
@@ -0,0 +1,85 @@
+import json
+from requests.structures import CaseInsensitiveDict
+from github_cache import GitHubCache, GitHubClient
+from sqlite_lru import SQLiteLRUStore
+
+class FakeResponse:
+    def __init__(self, status_code, body=b"", headers=None):
+        self.status_code = status_code
+        self.content = body
+        self.headers = CaseInsensitiveDict(headers or {})
+        self.encoding = "utf-8"
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        for start in range(0, len(self.content), chunk_size):
+            chunk = self.content[start:start + chunk_size]
+            yield chunk.decode("utf-8") if decode_unicode else chunk
+
+    def json(self):
+        return json.loads(self.content)
+
+    def close(self):
+        pass
+
+class FakeHttpClient:
+    """Answers with the given responses in order and records the headers of each request."""
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.sent_headers = []
+
+    def request(self, method, url, params=None, headers=None, stream=False, **kwargs):
+        self.sent_headers.append(headers)
+        return self.responses.pop(0)
+
+def test_lru_store_evicts_the_least_recently_used_rows(tmp_path):
+    store = SQLiteLRUStore(str(tmp_path / "lru.db"), "rows", ("value TEXT",), 10)
+    store.set("a", ("aaaa",), 4)
+    store.set("b", ("bbbb",), 4)
+    assert store.get("a") == ("aaaa",)
+    store.set("c", ("cccc",), 4)
+    assert store.get("b") is None
+    assert store.get("a") == ("aaaa",) and store.get("c") == ("cccc",)
+    # A row larger than the whole store isn't stored, and doesn't evict the others
+    assert store.set("d", ("d" * 20,), 20) is False
+    assert store.get("a") == ("aaaa",)
+    store.close()
+
+def test_not_modified_response_is_served_from_the_cache(tmp_path):
+    cache = GitHubCache(str(tmp_path / "github.db"))
+    http_client = FakeHttpClient(FakeResponse(200, b'{"number": 1}', {"ETag": '"v1"', "Content-Type": "application/json"}),
+                                 FakeResponse(304))
+    client = GitHubClient(http_client, cache)
+    assert client.get("https://api.github.com/repos/o/r/pulls/1").json() == {"number": 1}
+    response = client.get("https://api.github.com/repos/o/r/pulls/1")
+    assert response.from_cache and response.json() == {"number": 1}
+    assert http_client.sent_headers[1]["If-None-Match"] == '"v1"'
+    cache.close()
+
+def test_streamed_response_is_cached_once_read_to_the_end(tmp_path):
+    cache = GitHubCache(str(tmp_path / "github.db"))
+    body = "diff --git a/é.py b/é.py\n".encode("utf-8")
+    http_client = FakeHttpClient(FakeResponse(200, body, {"ETag": '"d1"'}), FakeResponse(304))
+    client = GitHubClient(http_client, cache)
+    with client.get("https://api.github.com/diff", stream=True) as response:
+        assert "".join(response.iter_content(chunk_size=5, decode_unicode=True)) == body.decode("utf-8")
+    with client.get("https://api.github.com/diff", stream=True) as response:
+        assert response.from_cache
+        # Chunks split inside a character are still decoded whole
+        assert "".join(response.iter_content(chunk_size=5, decode_unicode=True)) == body.decode("utf-8")
+    cache.close()
+
+def test_responses_over_the_size_cap_are_not_cached(tmp_path):
+    cache = GitHubCache(str(tmp_path / "github.db"), max_response_bytes=10)
+    http_client = FakeHttpClient(FakeResponse(200, b"x" * 100, {"ETag": '"big"'}), FakeResponse(200, b"x" * 100))
+    client = GitHubClient(http_client, cache)
+    with client.get("https://api.github.com/diff", stream=True) as response:
+        assert len(b"".join(response.iter_content(chunk_size=30))) == 100
+    client.get("https://api.github.com/diff")
+    assert "If-None-Match" not in http_client.sent_headers[1]
+    cache.close()
+
+def test_rate_limited_response_is_retried(tmp_path):
+    http_client = FakeHttpClient(FakeResponse(429, headers={"Retry-After": "0"}), FakeResponse(200, b"{}"))
+    client = GitHubClient(http_client, max_wait=0)
+    assert client.get("https://api.github.com/user").status_code == 200
+    assert len(http_client.sent_headers) == 2
@@ -0,0 +1,37 @@
+def make_files(*sizes):
+    return [{"tokens": [0] * size} for size in sizes]
+
+def test_pack_files_groups_small_files_first_fit_decreasing(code_review):
+    sizes = [50, 400, 300, 100]
+    groups = code_review.pack_files(make_files(*sizes), 500)
+    assert groups == [[0, 1], [2, 3]]
+    for group in groups:
+        assert sum(sizes[idx] + code_review.PACK_SEPARATOR_TOKENS for idx in group) <= 500
+
+def test_pack_files_leaves_large_files_on_their_own(code_review):
+    assert code_review.pack_files(make_files(600, 10), 500) == [[0], [1]]
+
+def test_pack_files_limits_files_per_request(code_review):
+    max_files = code_review.MAX_TOKENS // code_review.PACK_REVIEW_TOKENS
+    groups = code_review.pack_files(make_files(*[1] * (max_files + 1)), 10000)
+    assert [len(group) for group in groups] == [max_files, 1]
+
+def test_split_review_by_file_matches_headings(code_review):
+    review = ("Intro text\n"
+              "### File: `src/app.py`\nLooks fine.\n"
+              "**File: util.py**\nRename x.\n"
+              "File: unknown.py\nIgnored.\n"
+              "File: src/app.py\nOne more thing.")
+    reviews = code_review.split_review_by_file(review, ["src/app.py", "lib/util.py"])
+    assert set(reviews) == {"src/app.py", "lib/util.py"}
+    assert reviews["lib/util.py"] == "**File: util.py**\nRename x."
+    assert reviews["src/app.py"].startswith("### File: `src/app.py`\nLooks fine.")
+    assert reviews["src/app.py"].endswith("File: src/app.py\nOne more thing.")
+
+def test_split_review_by_file_matches_a_unique_basename(code_review):
+    reviews = code_review.split_review_by_file("File: other/app.py\nHmm.", ["a/app.py", "b/util.py"])
+    assert reviews == {"a/app.py": "File: other/app.py\nHmm."}
+    assert code_review.split_review_by_file("File: other/app.py\nHmm.", ["a/app.py", "b/app.py"]) == {}
+
+def test_segment_diff_by_files_splits_text_only_on_newlines(code_review):
+    diff = "diff --git a/a.py b/a.py\n@@ -1 +1 @@\n-x\n+s = '\x0cdiff --git a/evil b/evil'"
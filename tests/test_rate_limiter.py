@@ -0,0 +1,105 @@
+import pytest
+import requests
+from requests.structures import CaseInsensitiveDict
+from rate_limiter import RateLimiter, TokenBucket
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers or {})
+
+    def close(self):
+        pass
+
+class FakeClient:
+    """Answers requests with the given responses in order, raising the exceptions among them."""
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def request(self, **kwargs):
+        self.calls += 1
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request(**kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request(**kwargs)
+
+def test_update_syncs_level_with_remaining_minus_in_flight():
+    bucket = TokenBucket(100)
+    bucket.update(60, 40, None, 5, bucket.updated)
+    assert bucket.capacity == 60
+    assert bucket.rate == 1.0
+    assert bucket.level == 35
+
+def test_update_refills_at_the_reported_reset_rate():
+    bucket = TokenBucket(100)
+    # 50 used, refilled in 10s, is faster than 100 per minute
+    bucket.update(100, 50, 10, 0, bucket.updated)
+    assert bucket.rate == 5.0
+    assert bucket.wait_time(60) == 2.0
+
+def test_update_never_goes_over_capacity():
+    bucket = TokenBucket(10)
+    bucket.update(None, 500, None, 0, bucket.updated)
+    assert bucket.level == 10
+
+def test_duration_to_seconds():
+    assert RateLimiter.duration_to_seconds("1h30m15s") == 5415
+    assert RateLimiter.duration_to_seconds("20ms") == 0.02
+    assert RateLimiter.duration_to_seconds(None) == 0
+
+def test_make_request_retries_throttled_and_failed_requests():
+    client = FakeClient(FakeResponse(429, {"retry-after": "0"}), requests.ConnectionError(), FakeResponse(200))
+    limiter = RateLimiter(100, 100000, max_retries=3, base_backoff=0.001, http_client=client)
+    assert limiter.make_request("http://test", data={"messages": []}).status_code == 200
+    assert client.calls == 3
+    assert (limiter.in_flight_requests, limiter.in_flight_tokens) == (0, 0)
+
+def test_make_request_returns_the_last_response_after_max_retries():
+    client = FakeClient(*[FakeResponse(503) for _ in range(3)])
+    limiter = RateLimiter(100, 100000, max_retries=2, base_backoff=0.001, http_client=client)
+    assert limiter.make_request("http://test").status_code == 503
+    assert client.calls == 3
+
+def test_release_syncs_the_buckets_with_the_response_headers():
+    limiter = RateLimiter(100, 100000)
+    limiter.reserve(1000)
+    limiter.release(1000, CaseInsensitiveDict({
+        "x-ratelimit-limit-requests": "10", "x-ratelimit-remaining-requests": "4",
+        "x-ratelimit-limit-tokens": "5000", "x-ratelimit-remaining-tokens": "3000"}))
+    assert (limiter.request_bucket.capacity, limiter.request_bucket.level) == (10, 4)
+    assert (limiter.token_bucket.capacity, limiter.token_bucket.level) == (5000, 3000)
+
+def test_post_that_times_out_reading_is_not_sent_again():
+    client = FakeClient(requests.ReadTimeout(), FakeResponse(200))
+    limiter = RateLimiter(100, 100000, max_retries=3, base_backoff=0.001, http_client=client)
+    with pytest.raises(requests.ReadTimeout):
+        limiter.make_request("http://test", method="POST", data={"messages": []})
+    assert client.calls == 1
+    # A GET is safe to send again
+    client = FakeClient(requests.ReadTimeout(), FakeResponse(200))
+    limiter = RateLimiter(100, 100000, max_retries=3, base_backoff=0.001, http_client=client)
+    assert limiter.make_request("http://test").status_code == 200
+
+def test_unlimited_bucket_until_limits_are_reported():
+    bucket = TokenBucket(None)
+    bucket.take(1000)
+    assert bucket.wait_time(1000) == 0
+    # Headers without a limit leave it unlimited
+    bucket.update(None, 3, None, 0, bucket.updated)
+    assert bucket.capacity is None and bucket.wait_time(1000) == 0
+    bucket.update(30, 20, None, 0, bucket.updated)
+    assert (bucket.capacity, bucket.level) == (30, 20)
+
+def test_backend_without_limits_is_not_rate_limited():
+    limiter = RateLimiter(None, None)
+    for _ in range(10):
+        limiter.reserve(10 ** 6)
+        limiter.release(10 ** 6, CaseInsensitiveDict())
+    assert limiter.try_reserve(10 ** 6) == 0
@@ -0,0 +1,48 @@
+from review_journal import ReviewJournal
+
+def open_journal(tmp_path, resume=False):
+    return ReviewJournal(str(tmp_path / "journal" / "pr.jsonl"), resume)
+
+def test_reviews_are_read_back_in_diff_order(tmp_path):
+    journal = open_journal(tmp_path)
+    journal.order = ["a", "b", "c"]
+    journal.record_review("b", "b.py", "File: b.py\nFine.")
+    journal.record_failure("a", "a.py", "HTTP 500", 1)
+    journal.record_review("a", "a.py", "File: a.py\nRetried.")
+    journal.record_failure("c", "c.py", "HTTP 400", 3)
+    assert list(journal.iter_reviews()) == ["File: a.py\nRetried.", "File: b.py\nFine.",
+                                            "File: c.py\nReview failed due to an error: HTTP 400"]
+    assert journal.is_done("a") and not journal.is_done("c")
+    journal.close()
+
+def test_resume_reuses_done_reviews_and_ignores_a_cut_off_record(tmp_path):
+    journal = open_journal(tmp_path)
+    journal.record_review("a", "a.py", "File: a.py\nFine.")
+    journal.record_failure("b", "b.py", "timeout", 1)
+    journal.close()
+    with open(journal.path, "ab") as file:
+        file.write(b'{"key": "c", "file": "c.py", "sta')
+    resumed = open_journal(tmp_path, resume=True)
+    assert resumed.get_review("a") == "File: a.py\nFine."
+    assert resumed.get_review("b") is None
+    assert resumed.read("c") is None
+    resumed.record_review("c", "c.py", "File: c.py\nFine.")
+    assert resumed.get_review("c") == "File: c.py\nFine."
+    resumed.close()
+    # The cut off record was dropped, so the record after it can be read by the next run too
+    resumed = open_journal(tmp_path, resume=True)
+    assert resumed.get_review("c") == "File: c.py\nFine."
+    resumed.close()
+
+def test_records_after_close_are_dropped(tmp_path):
+    journal = open_journal(tmp_path)
+    journal.order = ["a", "b"]
+    journal.record_review("a", "a.py", "File: a.py\nFine.")
+    journal.close()
+    # A file that was still being reviewed when a cancelled job closed its journal
+    journal.record_review("b", "b.py", "File: b.py\nLate.")
+    assert list(journal.iter_reviews()) == ["File: a.py\nFine."]
+
+def test_make_key_depends_on_the_diff_and_model():
+    assert ReviewJournal.make_key("diff", "gpt-4") == ReviewJournal.make_key("diff", "gpt-4")
+    assert ReviewJournal.make_key("diff", "gpt-4") != ReviewJournal.make_key("diff", "gpt-3.5-turbo")
@@ -0,0 +1,77 @@
+import hmac
+import json
+import time
+import hashlib
+import threading
+import urllib.error
+import urllib.request
+import pytest
+from review_server import ReviewJob, ReviewJobQueue, ReviewServer, verify_signature
+
+def test_a_newer_push_replaces_the_pending_job_and_cancels_the_running_one():
+    started = threading.Event()
+    release = threading.Event()
+    handled = []
+    def handle_job(job):
+        handled.append(job)
+        started.set()
+        release.wait(5)
+    queue = ReviewJobQueue(handle_job, workers=1)
+    first = ReviewJob("o", "r", 1, "aaaaaaa")
+    assert queue.submit(first)
+    assert started.wait(5)
+    # The same commit again is ignored
+    assert not queue.submit(ReviewJob("o", "r", 1, "aaaaaaa"))
+    second, third = ReviewJob("o", "r", 1, "bbbbbbb"), ReviewJob("o", "r", 1, "ccccccc")
+    assert queue.submit(second) and queue.submit(third)
+    assert first.cancelled.is_set() and second.cancelled.is_set() and not third.cancelled.is_set()
+    assert queue.stats() == {"pending": 1, "running": 1}
+    release.set()
+    for _ in range(100):
+        if len(handled) == 2 and queue.stats() == {"pending": 0, "running": 0}:
+            break
+        time.sleep(0.05)
+    assert handled == [first, third]
+    queue.stop()
+
+def test_verify_signature():
+    body = b'{"action": "opened"}'
+    signature = "sha256=" + hmac.new(b"secret", body, hashlib.sha256).hexdigest()
+    assert verify_signature("secret", body, signature)
+    assert not verify_signature("secret", body, "sha256=0")
+    assert not verify_signature("secret", body, None)
+
+def test_server_needs_a_secret_to_listen_on_other_addresses():
+    queue = ReviewJobQueue(lambda job: None, workers=1)
+    with pytest.raises(ValueError):
+        ReviewServer(("0.0.0.0", 0), queue)
+    queue.stop()
+
+@pytest.fixture
+def server():
+    queued = []
+    queue = ReviewJobQueue(queued.append, workers=1)
+    server = ReviewServer(("127.0.0.1", 0), queue, "secret", ["Owner/Repo"])
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    queue.stop()
+
+def deliver(server, owner, secret="secret"):
+    body = json.dumps({"action": "synchronize", "repository": {"owner": {"login": owner}, "name": "repo"},
+                       "pull_request": {"number": 7, "head": {"sha": "0123456789"}}}).encode("utf-8")
+    signature = "sha256=" + hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+    request = urllib.request.Request(f"http://127.0.0.1:{server.server_address[1]}/", body, {
+        "X-GitHub-Event": "pull_request", "X-Hub-Signature-256": signature, "Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+def test_deliveries_are_checked_and_limited_to_configured_repos(server):
+    assert deliver(server, "owner") == 202
+    assert deliver(server, "someone-else") == 403
+    assert deliver(server, "owner", secret="wrong") == 401
@@ -0,0 +1,24 @@
+import pytest
+from review_journal import ReviewJournal
+
+def test_combined_reviews_match_files_by_key(code_review, tmp_path):
+    general = ReviewJournal(str(tmp_path / "general.jsonl"))
+    security = ReviewJournal(str(tmp_path / "security.jsonl"))
+    for journal in (general, security):
+        journal.order = ["a", "b"]
+    general.record_review("a", "a.py", "File: a.py\nGeneral a.")
+    general.record_review("b", "b.py", "File: b.py\nGeneral b.")
+    # The security review of a.py is missing, b.py's must still line up with b.py
+    security.record_review("b", "b.py", "File: b.py\nSecurity b.")
+    combined = list(code_review.iter_combined_reviews(["general", "security"], [general, security]))
+    assert combined == ["File: a.py\nGeneral review:\nGeneral a.\n\nSecurity review:\nNo review was recorded.",
+                        "File: b.py\nGeneral review:\nGeneral b.\n\nSecurity review:\nSecurity b."]
+    general.close()
+    security.close()
+
+def test_parse_review_types(code_review):
+    types = ["general", "security", "style"]
+    assert code_review.parse_review_types("security, general", types) == ["security", "general"]
+    assert code_review.parse_review_types("all", types) == types
+    with pytest.raises(ValueError):
+        code_review.parse_review_types("bogus", types)
@@ -0,0 +1,62 @@
+import io
+import functools
+from stream_writer import OrderedStreamWriter
+from review_cache import ReviewCache
+
+class ByteTokenizer:
+    """One token per byte, so chunk sizes are easy to reason about."""
+    def encode(self, text):
+        return list(text.encode("utf-8"))
+
+    def decode(self, tokens):
+        return bytes(tokens).decode("utf-8", errors="replace")
+
+    def decode_tokens_bytes(self, tokens):
+        return [bytes((token,)) for token in tokens]
+
+def test_later_files_are_buffered_until_earlier_files_finish():
+    output = io.StringIO()
+    writer = OrderedStreamWriter(output)
+    writer.write(1, "File: b.py\n")
+    writer.write(0, "File: a.py\n")
+    writer.write(1, "B")
+    assert output.getvalue() == "File: a.py\n"
+    writer.write(0, "A")
+    writer.finish(0)
+    assert output.getvalue() == "File: a.py\nA\n\nFile: b.py\nB"
+    writer.write(1, "!")
+    writer.finish(1)
+    assert output.getvalue() == "File: a.py\nA\n\nFile: b.py\nB!"
+
+def test_files_without_text_get_no_separator():
+    output = io.StringIO()
+    writer = OrderedStreamWriter(output)
+    writer.finish(0)
+    writer.write(1, "File: b.py")
+    assert output.getvalue() == "File: b.py"
+
+def test_retry_after_a_cut_off_chunk_streams_each_chunk_once_and_caches_only_complete_text(code_review, tmp_path,
+                                                                                            monkeypatch):
+    calls = []
+    def request_review(content, backend, prompt, model, estimated_tokens, on_delta=None, diff_first=False):
+        calls.append(content)
+        if len(calls) == 2:
+            on_delta("File: a.py\nHal")
+            raise code_review.ReviewError("connection reset")
+        text = f"File: a.py\nChunk {len(calls)}\n"
+        on_delta(text)
+        return {"choices": [{"message": {"content": text}}]}
+    monkeypatch.setattr(code_review, "request_review", request_review)
+    cache = ReviewCache(str(tmp_path / "reviews.db"), 10 ** 6)
+    streamed = io.StringIO()
+    review_function = functools.partial(code_review.review_file_segment, "x" * 100, ByteTokenizer(), None, "prompt",
+                                        "gpt-4", cache, chunk_size=60, finished_chunks=[])
+    review = code_review.run_review_task(review_function, [{"filename": "a.py", "journal_key": "a"}],
+                                         on_delta=streamed.write)
+    # The first chunk isn't sent again, the cut off second chunk is
+    assert calls == ["x" * 60, "x" * 40, "x" * 40]
+    assert review == streamed.getvalue()
+    assert code_review.STREAM_RETRY_NOTE in review
+    cache_key = ReviewCache.make_key("x" * 100, "prompt", "gpt-4", code_review.MAX_TOKENS)
+    assert cache.get(cache_key) == "File: a.py\nChunk 1\nFile: a.py\nChunk 3\n"
+    cache.close()